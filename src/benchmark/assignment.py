@@ -0,0 +1,69 @@
+import os, sys, time
+import numpy
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matching.assignment import ASSIGNMENT_BACKENDS
+
+PHASH_THRESHOLD = 12.0
+MATCHED_FRACTION = 0.8  # share of the reference images with an attacked version in the target
+CONFLICT_FRACTION = 0.1  # share of the matched images a near-duplicate competes for
+MUNKRES_MAX_SIZE = 1000  # the pure-Python solver takes too long above this
+
+
+def syntheticDistances(size, generator):
+    # unrelated 64-bit pHashes differ by ~32 bits, attacked versions only by a few
+    distances = generator.binomial(64, 0.5, (size, size)).astype(numpy.float64)
+    matchedRows = generator.choice(size, int(size * MATCHED_FRACTION), replace=False)
+    matchedColumns = generator.permutation(size)[: len(matchedRows)]
+    distances[matchedRows, matchedColumns] = generator.binomial(64, 0.05, len(matchedRows))
+
+    # some matches get a near-duplicate in an unmatched row (or column) while their image is
+    # just above the threshold from an unmatched column (or row), which is where the backends
+    # disagree: [[5, 13], [6, 40]] at 12 gets (1, 0) from munkres and dense, (0, 0) from
+    # sparse and greedy
+    unmatchedRows = numpy.setdiff1d(numpy.arange(size), matchedRows)
+    unmatchedColumns = numpy.setdiff1d(numpy.arange(size), matchedColumns)
+    conflicts = min(int(len(matchedRows) * CONFLICT_FRACTION), len(unmatchedRows))
+    for conflict in range(conflicts):
+        row, column = matchedRows[conflict], matchedColumns[conflict]
+        otherRow, otherColumn = unmatchedRows[conflict], unmatchedColumns[conflict]
+        nearDuplicate = generator.binomial(64, 0.05)
+        aboveThreshold = PHASH_THRESHOLD + generator.integers(1, 4)
+        if conflict % 2 == 0:
+            distances[otherRow, column] = nearDuplicate
+            distances[row, otherColumn] = aboveThreshold
+        else:
+            distances[row, otherColumn] = nearDuplicate
+            distances[otherRow, column] = aboveThreshold
+
+    return distances
+
+
+if len(sys.argv) < 2:
+    print("Usage: python src/benchmark/assignment.py 100 1000 10000")
+    exit(-1)
+
+generator = numpy.random.default_rng(0)
+for size in [int(argument) for argument in sys.argv[1:]]:
+    distances = syntheticDistances(size, generator)
+
+    reference = None
+    for name, backend in ASSIGNMENT_BACKENDS.items():
+        if name == "munkres" and size > MUNKRES_MAX_SIZE:
+            continue
+
+        start = time.perf_counter()
+        matches = backend(distances, PHASH_THRESHOLD)
+        elapsed = time.perf_counter() - start
+
+        matches = set(matches)
+        if reference is None:
+            reference = matches
+        totalDistance = sum(distances[row][column] for row, column in matches)
+        print(
+            f"{size}x{size} {name}: {elapsed:.3f}s, {len(matches)} matches, "
+            f"total distance {totalDistance:.0f}, "
+            f"{len(matches - reference)} matches differing from {'munkres' if size <= MUNKRES_MAX_SIZE else 'dense'}"
+        )
+
+    print()
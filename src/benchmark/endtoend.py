@@ -0,0 +1,175 @@
+import argparse, json, os, platform, random, resource, subprocess, sys, tempfile
+import imagehash, numpy
+
+from cv2 import cv2
+from multiprocessing import cpu_count
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from generation.index import transformPipeline
+from matching.index import CASCADE_STAGES, cascadeChangelist, loadGallery
+from matching.profiling import startProfiling, stopProfiling
+from matching.workers import workerEngine
+
+SIZES = [10, 100]  # reference images of each synthesized gallery pair
+SYNTHETIC_IMAGE_SIZE = 512
+SYNTHETIC_SHAPES = 8  # shapes drawn over the random colour field of every original
+ATTACKED_FRACTION = 0.8  # originals with an attacked version in the target, others get removed
+ADDED_FRACTION = 0.1  # unrelated images added to the target, relative to the reference size
+
+
+def syntheticImageOf(rng):
+    # a smooth random colour field with a few shapes on top, so that every original only
+    # resembles its own attacks
+    image = cv2.resize(
+        rng.integers(0, 256, (4, 4, 3), dtype=numpy.uint8),
+        (SYNTHETIC_IMAGE_SIZE, SYNTHETIC_IMAGE_SIZE),
+        interpolation=cv2.INTER_CUBIC,
+    )
+    for _ in range(SYNTHETIC_SHAPES):
+        color = [int(channel) for channel in rng.integers(0, 256, 3)]
+        corner = tuple(
+            int(coordinate) for coordinate in rng.integers(0, SYNTHETIC_IMAGE_SIZE, 2)
+        )
+        if rng.random() < 0.5:
+            radius = int(rng.integers(SYNTHETIC_IMAGE_SIZE // 16, SYNTHETIC_IMAGE_SIZE // 4))
+            cv2.circle(image, corner, radius, color, -1)
+        else:
+            otherCorner = tuple(
+                int(coordinate) for coordinate in rng.integers(0, SYNTHETIC_IMAGE_SIZE, 2)
+            )
+            cv2.rectangle(image, corner, otherCorner, color, -1)
+
+    return image
+
+
+def synthesizeGalleries(folder, size, seed):
+    # writes a reference and an attacked target gallery, one image at a time, and returns the
+    # (reference, target) pairs the changelist should contain, attacks keeping their filenames
+    rng = numpy.random.default_rng(seed)
+    random.seed(seed)  # albumentations draws its parameters from both generators
+    numpy.random.seed(seed)
+
+    referenceFolder = os.path.join(folder, "reference")
+    targetFolder = os.path.join(folder, "target")
+    os.makedirs(referenceFolder, exist_ok=True)
+    os.makedirs(targetFolder, exist_ok=True)
+
+    expectedMatches = []
+    for index in range(size):
+        filename = f"{index:05}.jpg"
+        image = syntheticImageOf(rng)
+        cv2.imwrite(os.path.join(referenceFolder, filename), image)
+        if rng.random() < ATTACKED_FRACTION:
+            attackedImage = transformPipeline(image=image)["image"]
+            cv2.imwrite(os.path.join(targetFolder, filename), attackedImage)
+            expectedMatches.append([filename, filename])
+
+    for index in range(int(size * ADDED_FRACTION)):
+        cv2.imwrite(os.path.join(targetFolder, f"added{index:05}.jpg"), syntheticImageOf(rng))
+
+    return referenceFolder, targetFolder, expectedMatches
+
+
+def runBenchmark(referenceFolder, targetFolder, expectedMatches):
+    # runs in a process of its own, so that its peak memory doesn't include the other sizes
+    startProfiling()
+    changelist, _ = cascadeChangelist(
+        loadGallery(referenceFolder), loadGallery(targetFolder), CASCADE_STAGES
+    )
+    profile = stopProfiling()
+    workerEngine().close()
+    peakWorkerRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    matches = {
+        (change["reference"], change["target"])
+        for change in changelist
+        if "reference" in change and "target" in change
+    }
+    expectedMatches = {tuple(match) for match in expectedMatches}
+    correctMatches = len(matches & expectedMatches)
+    imageCount = len(os.listdir(referenceFolder)) + len(os.listdir(targetFolder))
+
+    return {
+        "references": len(os.listdir(referenceFolder)),
+        "targets": len(os.listdir(targetFolder)),
+        "seconds": profile["seconds"],
+        "imagesPerSecond": imageCount / profile["seconds"],
+        "stages": profile["stages"],
+        "counters": profile["counters"],
+        "peakTreeMemoryMegabytes": profile["peakTreeMemoryMegabytes"],
+        "peakWorkerRssMegabytes": peakWorkerRss,
+        "matches": len(matches),
+        "expectedMatches": len(expectedMatches),
+        "precision": correctMatches / len(matches) if len(matches) > 0 else 1.0,
+        "recall": correctMatches / len(expectedMatches) if len(expectedMatches) > 0 else 1.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the matching speed and accuracy on synthesized galleries"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=SIZES,
+        help=f"comma-separated reference gallery sizes (default: {','.join(map(str, SIZES))})",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--folder",
+        help="where to synthesize the galleries, kept afterwards (default: a temporary folder)",
+    )
+    parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+    parser.add_argument("--run", nargs=3, help=argparse.SUPPRESS)  # a single size, internally
+    arguments = parser.parse_args()
+
+    if arguments.run is not None:
+        referenceFolder, targetFolder, expectedMatchesPath = arguments.run
+        with open(expectedMatchesPath) as file:
+            expectedMatches = json.load(file)
+        print(json.dumps(runBenchmark(referenceFolder, targetFolder, expectedMatches)))
+        exit(0)
+
+    with tempfile.TemporaryDirectory() as temporaryFolder:
+        folder = arguments.folder or temporaryFolder
+        results = []
+        for size in arguments.sizes:
+            sizeFolder = os.path.join(folder, str(size))
+            referenceFolder, targetFolder, expectedMatches = synthesizeGalleries(
+                sizeFolder, size, arguments.seed
+            )
+            expectedMatchesPath = os.path.join(sizeFolder, "expected.json")
+            with open(expectedMatchesPath, "w") as file:
+                json.dump(expectedMatches, file)
+
+            run = subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--run",
+                    referenceFolder,
+                    targetFolder,
+                    expectedMatchesPath,
+                ],
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            results.append({"size": size, **json.loads(run.stdout)})
+            print(f"{size} images done", file=sys.stderr)
+
+    report = {
+        "seed": arguments.seed,
+        "environment": {
+            "cpus": cpu_count(),
+            "python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "imagehash": imagehash.__version__,
+        },
+        "results": results,
+    }
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump(report, file, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
@@ -0,0 +1,45 @@
+import os, sys, time
+import imagehash
+
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matching.index import PHASH_THRESHOLD, streamGallery
+
+
+def timedGallery(folder, reduced, workers):
+    start = time.perf_counter()
+    gallery = list(streamGallery(folder, reduced, workers))
+
+    return gallery, time.perf_counter() - start
+
+
+if len(sys.argv) < 2:
+    print('Usage: python src/benchmark/loading.py "/code/samples/001 - gin/original" ...')
+    exit(-1)
+
+for folder in sys.argv[1:]:
+    serialGallery, serialTime = timedGallery(folder, False, 1)
+    _, threadedTime = timedGallery(folder, False, os.cpu_count() * 2)
+    reducedGallery, reducedTime = timedGallery(folder, True, os.cpu_count() * 2)
+
+    distances = [
+        imagehash.phash(Image.fromarray(fullImage["content"]))
+        - imagehash.phash(Image.fromarray(reducedImage["content"]))
+        for fullImage, reducedImage in zip(serialGallery, reducedGallery)
+    ]
+
+    print(f"{folder} ({len(serialGallery)} images)")
+    print(
+        f"    serial full decode: {serialTime:.3f}s, {len(serialGallery) / serialTime:.1f} images/s"
+    )
+    print(
+        f"    threaded full decode: {threadedTime:.3f}s, {len(serialGallery) / threadedTime:.1f} images/s"
+    )
+    print(
+        f"    threaded reduced decode: {reducedTime:.3f}s, {len(serialGallery) / reducedTime:.1f} images/s"
+    )
+    print(
+        f"    pHash distance between full and reduced decode: max {max(distances, default=0)}, "
+        f"mean {sum(distances) / max(len(distances), 1):.2f} (threshold {PHASH_THRESHOLD})"
+    )
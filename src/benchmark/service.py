@@ -0,0 +1,57 @@
+import json, os, sys, time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from server import server
+
+RETRY_DELAY = 0.1  # seconds to wait before resubmitting a diff rejected by a full queue
+
+
+def diffOf(referenceId, targetFolder):
+    client = server.test_client()
+    while True:
+        response = client.post(
+            f"/references/{referenceId}/diffs", json={"folder": targetFolder}
+        )
+        if response.status_code != 503:
+            break
+        time.sleep(RETRY_DELAY)
+
+    changelist = client.get(f"/jobs/{response.get_json()['job']}/changelist")
+    return [json.loads(line) for line in changelist.get_data(as_text=True).splitlines()]
+
+
+if len(sys.argv) < 3:
+    print(
+        'Usage: python src/benchmark/service.py "/code/samples/001 - gin/original" '
+        '"/code/samples/001 - gin/attack007" [jobs] [concurrency]'
+    )
+    exit(-1)
+
+referenceFolder, targetFolder = sys.argv[1], sys.argv[2]
+jobCount = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+
+start = time.perf_counter()
+referenceId = server.test_client().post("/references", json={"folder": referenceFolder})
+referenceId = referenceId.get_json()["reference"]
+print(f"reference registration: {time.perf_counter() - start:.3f}s")
+
+start = time.perf_counter()
+changelist = diffOf(referenceId, targetFolder)
+print(f"first diff: {time.perf_counter() - start:.3f}s, {len(changelist)} changes")
+
+start = time.perf_counter()
+with ThreadPoolExecutor(concurrency) as executor:
+    changelists = list(
+        executor.map(diffOf, [referenceId] * jobCount, [targetFolder] * jobCount)
+    )
+elapsed = time.perf_counter() - start
+
+print(
+    f"{jobCount} warm diffs, {concurrency} at once: {elapsed:.3f}s, "
+    f"{jobCount / elapsed:.2f} jobs/s, "
+    f"{sum(changes == changelist for changes in changelists)} identical to the first diff"
+)
+print(json.dumps(server.test_client().get("/stats").get_json(), indent=4))
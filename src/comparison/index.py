@@ -1,254 +1,337 @@
 # Testing puposes
 
-import albumentations, imagehash, os, sys
+import albumentations, argparse, collections, functools, imagehash, json, numpy, os, sys
 
-from cv2 import cv2
+from multiprocessing import Pool, cpu_count
 from PIL import Image
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matching.index import (
+    IDENTITY_PIPELINE,
+    MAX_ANGLE,
+    POPCOUNT_TABLE,
+    decodedImageOf,
+    fingerprintOf,
+    packedHashOf,
+    popcountDistancesBetween,
+)
+from matching.segments import multiHashDistancesBetween
+from matching.tiles import TILE_MEMORY_BUDGET, rowBlocksOf
 
-def loadImagesFromFolder(folder):
-    images = []
-    for filename in os.listdir(folder):
-        image = cv2.imread(os.path.join(folder, filename))
-        if image is not None:
-            images.append((filename, image))
+COMPARISON_WORKERS = cpu_count()
+COMPARISON_CHUNK_SIZE = 4  # images handed to a worker at once
+DISTANCE_DECIMALS = 6  # crop-resistant distances get rounded to this many decimals when counted
 
-    return images
-
-
-def transformImages(images, transformPipeline):
-    transformed = []
-    for image in images:
-        transformed.append((image[0], transformPipeline(image=image[1])["image"]))
-
-    return transformed
-
-
-def cv2ToPIL(images):
-    converted = []
-    for image in images:
-        converted.append((image[0], Image.fromarray(image[1])))
-
-    return converted
-
-
-if len(sys.argv) != 3:
-    print(
-        'Usage: python src/comparison/index.py "/code/samples/001 - gin/original" "/code/samples/002 - gin/original"'
-    )
-    exit(-1)
-
-firstFolder = os.path.normpath(sys.argv[1])
-secondFolder = os.path.normpath(sys.argv[2])
-
-size = 512
-hashFunctions = [
+# every family gets compared against the targets rotated within +-maxAngle (5 degree steps),
+# with and without a horizontal flip, the lowest distance being kept, as the matching does
+HASH_FAMILIES = {
     # best against (<= 2.0): blur, channel shuffle, coarse dropout, downscale, horizontal flip, hue saturation value, iso noise, motion blur, multiplicative noise, optical distortion, posterize, random brightness, random contrast, random gamma, rgb shift, to gray
     # so-so against (<= 4.0): clahe, to sepia
     # worst against (> 4.0): equalize, grid distortion, random shadow, random sized crop, rotate, RANDOM COMBINATIONS, DIFFERENT IMAGES
     # CONCLUSION: not usable due to low performance on recognizing different images
-    # (
-    #     "aHash",
-    #     imagehash.average_hash,
-    #     [
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #     ],
-    # ),
+    "aHash": (imagehash.average_hash, 0),
     # best against (<= 6.0): blur, channel shuffle, coarse dropout, downscale, horizontal flip, hue saturation value, iso noise, motion blur, multiplicative noise, optical distortion, posterize, random contrast, random gamma, rgb shift, to gray, DIFFERENT IMAGES
     # so-so against (<= 12.0): clahe, equalize, random brightness, to sepia, RANDOM COMBINATIONS
     # worst against (> 12.0): grid distortion, random shadow, random sized crop, rotate
-    # CONCLUSION: very good on on differentiating between attack images and new ones
-    # (
-    #     "pHash",
-    #     imagehash.phash,
-    #     [
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #         # CONCLUSION: to be used together with such rotations when it says > 12.0 because it solves the rotate problem
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.Rotate(limit=(-10, -10), p=1.0),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.Rotate(limit=(-10, -10), p=1.0),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.Rotate(limit=(10, 10), p=1.0),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.Rotate(limit=(10, 10), p=1.0),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #     ],
-    # ),
+    # CONCLUSION: very good on on differentiating between attack images and new ones, rotations
+    # of the targets solving the rotate problem
+    "pHash": (imagehash.phash, MAX_ANGLE),
     # best against (<= 2.0): blur, horizontal flip, iso noise, motion blur, posterize, random gamma, rgb shift, to gray
     # so-so against (<= 4.0): clahe, channel shuffle, coarse dropout, equalize, hue saturation value, multiplicative noise, optical distortion, random contrast, RANDOM COMBINATIONS, DIFFERENT IMAGES
     # worst against (> 4.0): downscale, grid distortion, random brightness, random shadow, random sized crop, rotate, to sepia
     # CONCLUSION: not usable due to low performance on differentiating between attack images and new ones
-    # (
-    #     "dHash",
-    #     imagehash.dhash,
-    #     [
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #     ],
-    # ),
-    # best against (<= 6.0):
-    # so-so against (<= 12.0):
-    # worst against (> 12.0):
-    # CONCLUSION:
-    # (
-    #     "wHash - haar",
-    #     imagehash.whash,
-    #     [
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #     ],
-    # ),
-    # best against (<= 6.0):
-    # so-so against (<= 12.0):
-    # worst against (> 12.0):
-    # CONCLUSION:
-    # (
-    #     "wHash - db4",
-    #     lambda img: imagehash.whash(img, mode="db4"),
-    #     [
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #     ],
-    # ),
-    # best against (<= 6.0):
-    # so-so against (<= 12.0):
-    # worst against (> 12.0):
-    # CONCLUSION:
-    # (
-    #     "colorHash",
-    #     imagehash.colorhash,
-    #     [
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #             ]
-    #         ),
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #                 albumentations.HorizontalFlip(p=1.0),
-    #             ]
-    #         ),
-    #     ],
-    # ),
+    "dHash": (imagehash.dhash, 0),
+    "wHash-haar": (imagehash.whash, 0),
+    "wHash-db4": (functools.partial(imagehash.whash, mode="db4"), 0),
+    "colorHash": (imagehash.colorhash, 0),
     # best against (<= 0.06): ~
     # so-so against (<= 0.09): ~
     # worst against (> 0.09): ~
     # CONCLUSION: to be used together with phash when it says > 12.0 because it solves the random sized crop problem
-    # (
-    #     "cropResistantHash",
-    #     lambda img: imagehash.crop_resistant_hash(img, hash_func=imagehash.colorhash),
-    #     [
-    #         albumentations.Compose(
-    #             [
-    #                 albumentations.Resize(size, size),
-    #             ]
-    #         ),
-    #     ],
-    # ),
-]
-
-firstImageList = loadImagesFromFolder(firstFolder)
-secondImageList = loadImagesFromFolder(secondFolder)
-
-for hashFunction in hashFunctions:
-    name = hashFunction[0]
-    hasher = hashFunction[1]
-    transformPipelines = hashFunction[2]
-
-    results = [64.0] * len(firstImageList)
-    firstImageSet = cv2ToPIL(transformImages(firstImageList, transformPipelines[0]))
-    for transformPipeline in transformPipelines:
-        secondImageSet = cv2ToPIL(transformImages(secondImageList, transformPipeline))
-        if len(firstImageSet) != len(secondImageSet):
-            print("Variable-length galleries not yet supported")
-            exit(-1)
-
-        for index in range(len(firstImageSet)):
-            firstImage = firstImageSet[index][1]
-            secondImage = secondImageSet[index][1]
-
-            total = 0
-            retries = 3
-            for _ in range(retries):
-                firstHash = hasher(firstImage)
-                secondHash = hasher(secondImage)
-
-                total = total + (firstHash - secondHash)
-
-            results[index] = min(results[index], total / retries)
-
-    for index in range(len(firstImageList)):
-        firstFilename = firstImageSet[index][0]
-        secondFilename = secondImageSet[index][0]
+    "cropResistantHash": (
+        functools.partial(imagehash.crop_resistant_hash, hash_func=imagehash.colorhash),
+        0,
+    ),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def pipelineOf(pipelineKey):
+    # None is the reference pipeline, (angle, flipped) the target ones
+    if pipelineKey is None:
+        return IDENTITY_PIPELINE
+
+    angle, flipped = pipelineKey
+    transforms = [albumentations.Rotate(limit=(angle, angle), p=1.0)]
+    if flipped:
+        transforms.append(albumentations.HorizontalFlip(p=1.0))
+
+    return albumentations.Compose(transforms)
+
+
+def pipelineKeysOf(maxAngle):
+    return [
+        (angle, flipped)
+        for flipped in [False, True]
+        for angle in range(-maxAngle, maxAngle + 5, 5)
+    ]
+
+
+def familyBitsOf(imageHash):
+    # packed words of a single hash, or the S x B segment bits of a crop-resistant one
+    if isinstance(imageHash, imagehash.ImageMultiHash):
+        fingerprint = fingerprintOf(imageHash)
+        return fingerprint.reshape(len(fingerprint), -1)
+
+    return packedHashOf(imageHash)
+
+
+def imageHashesOf(families, pipelineKeys, path):
+    # every family's hashes of an image, each pipeline getting applied once for all of them;
+    # returns {family: [bits for each of its pipelines]}, or None if it's not an image
+    image = decodedImageOf(path)
+    if image is None:
+        return None
+
+    familyPipelineKeys = {
+        family: {None, *pipelineKeysOf(HASH_FAMILIES[family][1])} for family in families
+    }
+    hashes = {family: [] for family in families}
+    for pipelineKey in pipelineKeys:
+        content = Image.fromarray(pipelineOf(pipelineKey)(image=image)["image"])
+        for family in families:
+            if pipelineKey in familyPipelineKeys[family]:
+                hashFunction = HASH_FAMILIES[family][0]
+                hashes[family].append(familyBitsOf(hashFunction(content)))
+
+    return hashes
+
+
+def galleryHashesOf(pool, folder, families, pipelineKeys):
+    # returns the filenames of the images in folder along with their hashes
+    filenames = sorted(os.listdir(folder))
+    results = pool.imap(
+        functools.partial(imageHashesOf, families, pipelineKeys),
+        [os.path.join(folder, filename) for filename in filenames],
+        chunksize=COMPARISON_CHUNK_SIZE,
+    )
+    gallery = [(filename, hashes) for filename, hashes in zip(filenames, results) if hashes]
+
+    return [filename for filename, _ in gallery], [hashes for _, hashes in gallery]
+
+
+def familyDistancesOf(family, referenceHashes, targetHashes, memoryBudget):
+    # yields the R x T distances, in blocks of references, each target keeping its closest
+    # pipeline
+    if family == "cropResistantHash":
+        referenceBits = [hashes[family][0] for hashes in referenceHashes]
+        targetBits = list(zip(*[hashes[family] for hashes in targetHashes]))
+        bytesPerPair = (len(targetBits) + 1) * 8
+
+        def distancesOf(referenceSlice, targetSlice):
+            return numpy.min(
+                [
+                    multiHashDistancesBetween(
+                        referenceBits[referenceSlice], pipelineBits[targetSlice], POPCOUNT_TABLE
+                    )
+                    for pipelineBits in targetBits
+                ],
+                axis=0,
+            ).round(DISTANCE_DECIMALS)
+
+    else:
+        referenceBits = numpy.stack([hashes[family][0] for hashes in referenceHashes])
+        targetBits = numpy.stack(
+            [
+                numpy.stack(pipelineBits)
+                for pipelineBits in zip(*[hashes[family] for hashes in targetHashes])
+            ]
+        )
+        bytesPerPair = len(targetBits) * (16 * referenceBits.shape[1] + 8)
 
+        def distancesOf(referenceSlice, targetSlice):
+            return popcountDistancesBetween(
+                referenceBits[referenceSlice], targetBits[:, targetSlice]
+            ).min(axis=1)
+
+    for referenceSlice, targetSlices in rowBlocksOf(
+        len(referenceHashes), len(targetHashes), bytesPerPair, memoryBudget
+    ):
+        yield referenceSlice, numpy.concatenate(
+            [distancesOf(referenceSlice, targetSlice) for targetSlice in targetSlices], axis=1
+        )
+
+
+def countsOf(distances):
+    values, counts = numpy.unique(distances, return_counts=True)
+    return collections.Counter(dict(zip(values.tolist(), counts.tolist())))
+
+
+def rocOf(sameCounts, differentCounts):
+    # a pair matches when its distance is at most the threshold; every distinct distance is a
+    # point of the curve
+    sameTotal = sum(sameCounts.values())
+    differentTotal = sum(differentCounts.values())
+    if sameTotal == 0 or differentTotal == 0:
+        return [], {}, None
+
+    roc = []
+    truePositives, falsePositives = 0, 0
+    for threshold in sorted(set(sameCounts) | set(differentCounts)):
+        truePositives += sameCounts[threshold]
+        falsePositives += differentCounts[threshold]
+        roc.append(
+            {
+                "threshold": threshold,
+                "truePositiveRate": truePositives / sameTotal,
+                "falsePositiveRate": falsePositives / differentTotal,
+            }
+        )
+
+    thresholds = {
+        # the highest threshold no different images got matched under
+        "noFalseMatches": max(
+            (point["threshold"] for point in roc if point["falsePositiveRate"] == 0),
+            default=None,
+        ),
+        # the one telling both kinds of pairs apart best (Youden's J statistic)
+        "balanced": max(
+            roc, key=lambda point: point["truePositiveRate"] - point["falsePositiveRate"]
+        )["threshold"],
+    }
+    rates = [(0.0, 0.0)] + [
+        (point["falsePositiveRate"], point["truePositiveRate"]) for point in roc
+    ]
+    auc = sum(
+        (fpr - previousFpr) * (tpr + previousTpr) / 2
+        for (previousFpr, previousTpr), (fpr, tpr) in zip(rates, rates[1:])
+    )
+
+    return roc, thresholds, auc
+
+
+def evaluate(referenceFolder, targetFolders, families, workers, memoryBudget, perImage=False):
+    # images are the same when their filenames are, as the attack generation keeps them
+    targetPipelineKeys = sorted(
+        {key for family in families for key in pipelineKeysOf(HASH_FAMILIES[family][1])}
+    )
+    sameCounts = {family: collections.Counter() for family in families}
+    differentCounts = {family: collections.Counter() for family in families}
+    sameDistances = {family: {} for family in families}
+
+    with Pool(workers) as pool:
+        referenceFilenames, referenceHashes = galleryHashesOf(
+            pool, referenceFolder, families, [None]
+        )
+        for targetFolder in targetFolders:
+            targetFilenames, targetHashes = galleryHashesOf(
+                pool, targetFolder, families, targetPipelineKeys
+            )
+            targetIndexes = {filename: index for index, filename in enumerate(targetFilenames)}
+            sameColumns = numpy.array(
+                [targetIndexes.get(filename, -1) for filename in referenceFilenames]
+            )
+
+            for family in families:
+                if len(referenceHashes) == 0 or len(targetHashes) == 0:
+                    continue
+
+                for referenceSlice, distances in familyDistancesOf(
+                    family, referenceHashes, targetHashes, memoryBudget
+                ):
+                    rows = numpy.flatnonzero(sameColumns[referenceSlice] >= 0)
+                    same = numpy.zeros(distances.shape, dtype=bool)
+                    same[rows, sameColumns[referenceSlice][rows]] = True
+                    sameCounts[family] += countsOf(distances[same])
+                    differentCounts[family] += countsOf(distances[~same])
+
+                    if perImage:
+                        for row in rows:
+                            filename = referenceFilenames[referenceSlice.start + row]
+                            sameDistances[family].setdefault(targetFolder, {})[
+                                filename
+                            ] = distances[row, sameColumns[referenceSlice][row]].item()
+
+    evaluation = {}
+    for family in families:
+        roc, thresholds, auc = rocOf(sameCounts[family], differentCounts[family])
+        evaluation[family] = {
+            "pairs": {
+                "same": sum(sameCounts[family].values()),
+                "different": sum(differentCounts[family].values()),
+            },
+            "distributions": {
+                "same": dict(sorted(sameCounts[family].items())),
+                "different": dict(sorted(differentCounts[family].items())),
+            },
+            "suggestedThresholds": thresholds,
+            "auc": auc,
+            "roc": roc,
+        }
+        if perImage:
+            evaluation[family]["sameImageDistances"] = sameDistances[family]
+
+    return evaluation
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluates how well hash families tell attacked images from different ones"
+    )
+    parser.add_argument("referenceFolder")
+    parser.add_argument("targetFolders", nargs="+")
+    parser.add_argument(
+        "--families",
+        type=lambda families: families.split(","),
+        default=list(HASH_FAMILIES),
+        help=f"comma-separated hash families to evaluate (default: {','.join(HASH_FAMILIES)})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=COMPARISON_WORKERS,
+        help="number of processes hashing images",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=TILE_MEMORY_BUDGET // (1024 * 1024),
+        help="megabytes the distances computed at once may take",
+    )
+    parser.add_argument(
+        "--per-image",
+        action="store_true",
+        help="also output the distance between every reference and its attacked version",
+    )
+    parser.add_argument("--output", help="file to write the JSON results to, instead of stdout")
+    arguments = parser.parse_args()
+
+    folders = [arguments.referenceFolder, *arguments.targetFolders]
+    unknownFamilies = set(arguments.families) - set(HASH_FAMILIES)
+    if not all(os.path.isdir(folder) for folder in folders) or unknownFamilies:
+        print(
+            'Usage: python src/comparison/index.py "/code/samples/001 - gin/original" "/code/samples/001 - gin/attack"*'
+        )
+        exit(-1)
+
+    evaluation = evaluate(
+        os.path.normpath(arguments.referenceFolder),
+        [os.path.normpath(folder) for folder in arguments.targetFolders],
+        arguments.families,
+        arguments.workers,
+        arguments.memory_budget * 1024 * 1024,
+        arguments.per_image,
+    )
+    for family, results in evaluation.items():
         print(
-            f"Using {name}, {firstFilename} and {secondFilename} differ by {results[index]}"
+            f"{family}: {results['pairs']['same']} same-image and "
+            f"{results['pairs']['different']} different-image pairs, "
+            f"suggested thresholds {results['suggestedThresholds']}, AUC {results['auc']}",
+            file=sys.stderr,
         )
 
-    print()
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump(evaluation, file, indent=4)
+    else:
+        print(json.dumps(evaluation, indent=4))
@@ -1,45 +1,97 @@
 # Testing puposes
 
-import albumentations, os, sys
+import albumentations, argparse, functools, json, numpy, os, random, warnings
 
 from cv2 import cv2
+from multiprocessing import Pool, SimpleQueue, cpu_count
 
+GENERATION_WORKERS = cpu_count()
+GENERATION_CHUNK_SIZE = 4  # originals handed to a worker at once
 
-def loadImagesFromFolder(folder):
-    images = []
-    for filename in os.listdir(folder):
-        image = cv2.imread(os.path.join(folder, filename))
-        if image is not None:
-            images.append((filename, image))
+# the pipeline only records the transforms it applies, it never gets replayed
+warnings.filterwarnings("ignore", "albumentations.* could work incorrectly in ReplayMode")
 
-    return images
 
+def attackSeedOf(seed, attackFolder, filename):
+    # every attacked image gets its own seed, so that a corpus doesn't depend on the order the
+    # workers pick images in
+    return f"{seed}/{attackFolder}/{filename}"
 
-def transformImages(images):
-    transformed = []
-    for image in images:
-        transformed.append((image[0], transformPipeline(image=image[1])["image"]))
 
-    return transformed
+def seedWorker(workerSeeds):
+    # forked workers would all inherit the parent's random state, and produce the same attacks
+    # when no seed is given; seeded runs reseed before every image anyway
+    pythonState, numpyState = workerSeeds.get().generate_state(2)
+    random.seed(int(pythonState))
+    numpy.random.seed(numpyState)
 
 
-def generateNextAttackFolderName(folder):
-    return "attack" + str(len(os.listdir(folder))).zfill(3)
+def attackImage(originalFolder, attackFolders, seed, filename):
+    # decodes an original once and writes each of its attacks, returning the transforms applied
+    image = cv2.imread(os.path.join(originalFolder, filename))
+    if image is None:
+        return filename, None
 
+    appliedTransforms = []
+    for attackFolder in attackFolders:
+        if seed is not None:
+            random.seed(attackSeedOf(seed, os.path.basename(attackFolder), filename))
+            numpy.random.seed(random.getrandbits(32))  # albumentations draws from both
 
-def saveTransformedImages(images, attackFolder):
-    os.makedirs(attackFolder, exist_ok=True)
-    for image in images:
-        cv2.imwrite(os.path.join(attackFolder, image[0]), image[1])
+        transformed = transformPipeline(image=image)
+        cv2.imwrite(os.path.join(attackFolder, filename), transformed["image"])
+        appliedTransforms.append(
+            [
+                transform["__class_fullname__"].split(".")[-1]
+                for transform in transformed["replay"]["transforms"]
+                if transform["applied"]
+            ]
+        )
 
+    return filename, appliedTransforms
+
+
+def generateNextAttackFolderNames(folder, count):
+    index = len(os.listdir(folder))
+    names = []
+    while len(names) < count:
+        name = "attack" + str(index).zfill(3)
+        if not os.path.exists(os.path.join(folder, name)):
+            names.append(name)
+        index += 1
+
+    return names
+
+
+def generateAttacks(originalFolder, attackFolders, seed=None, workers=GENERATION_WORKERS):
+    # images get streamed through the pool, only the transforms applied to them being kept
+    for attackFolder in attackFolders:
+        os.makedirs(attackFolder, exist_ok=True)
+
+    groundTruth = {os.path.basename(attackFolder): {} for attackFolder in attackFolders}
+    workerSeeds = SimpleQueue()
+    for workerSeed in numpy.random.SeedSequence().spawn(workers):
+        workerSeeds.put(workerSeed)
+
+    with Pool(workers, seedWorker, (workerSeeds,)) as pool:
+        results = pool.imap_unordered(
+            functools.partial(attackImage, originalFolder, attackFolders, seed),
+            sorted(os.listdir(originalFolder)),
+            chunksize=GENERATION_CHUNK_SIZE,
+        )
+        for filename, appliedTransforms in results:
+            if appliedTransforms is None:
+                continue
+
+            for attackFolder, transforms in zip(attackFolders, appliedTransforms):
+                groundTruth[os.path.basename(attackFolder)][filename] = transforms
+
+    return groundTruth
 
-if len(sys.argv) != 2:
-    print('Usage: python src/generation/index.py "/code/samples/001 - gin/original"')
-    exit(-1)
 
 size = 512
 probability = 0.2
-transformPipeline = albumentations.Compose(
+transformPipeline = albumentations.ReplayCompose(
     [
         albumentations.Resize(size, size),
         albumentations.Blur(p=probability),  # 2
@@ -70,8 +122,50 @@ transformPipeline = albumentations.Compose(
     ]
 )
 
-originalPath, originalFolder = os.path.split(os.path.normpath(sys.argv[1]))
-originalImages = loadImagesFromFolder(os.path.join(originalPath, originalFolder))
-transformedImages = transformImages(originalImages)
-attackFolder = generateNextAttackFolderName(originalPath)
-saveTransformedImages(transformedImages, os.path.join(originalPath, attackFolder))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Writes attacked copies of a photo gallery next to it, as attackNNN folders"
+    )
+    parser.add_argument("originalFolder")
+    parser.add_argument(
+        "--attacks", type=int, default=1, help="number of attack folders to generate"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=GENERATION_WORKERS,
+        help="number of processes transforming images",
+    )
+    parser.add_argument(
+        "--seed", help="makes the attacks reproducible, the same seed giving the same corpus"
+    )
+    parser.add_argument(
+        "--manifest",
+        help="file to write the transforms applied to every attacked image into, as JSON",
+    )
+    arguments = parser.parse_args()
+
+    if not os.path.isdir(arguments.originalFolder):
+        print('Usage: python src/generation/index.py "/code/samples/001 - gin/original"')
+        exit(-1)
+
+    originalPath, originalFolder = os.path.split(os.path.normpath(arguments.originalFolder))
+    attackFolders = [
+        os.path.join(originalPath, name)
+        for name in generateNextAttackFolderNames(originalPath, arguments.attacks)
+    ]
+    groundTruth = generateAttacks(
+        os.path.join(originalPath, originalFolder),
+        attackFolders,
+        arguments.seed,
+        arguments.workers,
+    )
+
+    if arguments.manifest is not None:
+        with open(arguments.manifest, "w") as file:
+            json.dump(
+                {"original": originalFolder, "seed": arguments.seed, "attacks": groundTruth},
+                file,
+                indent=4,
+                sort_keys=True,
+            )
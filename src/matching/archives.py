@@ -0,0 +1,104 @@
+import collections, mimetypes, os, posixpath, tarfile, threading, zipfile
+
+MAX_OPEN_ARCHIVES = 8  # archives lazy galleries keep open to read their members from
+
+openArchives = collections.OrderedDict()  # path -> zip or tar archive
+archivesLock = threading.Lock()  # neither archive reads its members thread-safely
+
+
+def isArchive(path):
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+def isGalleryMember(name):
+    # skips folders, hidden files (e.g. macOS resource forks) and anything but images; names
+    # get normalized first, as archiving a folder from inside it prefixes them with ./
+    parts = posixpath.normpath(name).split("/")
+    if any(part.startswith(".") or part == "__MACOSX" for part in parts):
+        return False
+
+    mimeType, _ = mimetypes.guess_type(parts[-1])
+    return mimeType is not None and mimeType.startswith("image/")
+
+
+def galleryMembersOf(archive):
+    # the images of an open archive, in the archive's order, along with their normalized member
+    # paths; these become filenames, which a changelist needs to be unique
+    names = set()
+    if isinstance(archive, zipfile.ZipFile):
+        members = (
+            (member, member.filename)
+            for member in archive.infolist()
+            if not member.is_dir() and isGalleryMember(member.filename)
+        )
+    else:
+        members = (
+            (member, member.name)
+            for member in archive
+            if member.isfile() and isGalleryMember(member.name)
+        )
+
+    for member, memberName in members:
+        name = posixpath.normpath(memberName)
+        if name in names:
+            raise ValueError(f"Archive holds {name} more than once")
+
+        names.add(name)
+        yield member, name
+
+    if len(names) == 0:
+        raise ValueError("Archive holds no images")
+
+
+def openedArchiveOf(path):
+    if zipfile.is_zipfile(path):
+        return zipfile.ZipFile(path)
+
+    return tarfile.open(path)
+
+
+def archiveNamesOf(path):
+    with openedArchiveOf(path) as archive:
+        return [name for _, name in galleryMembersOf(archive)]
+
+
+def archiveMembersOf(path):
+    # yields the (normalized member path, member path, content) of every image, reading the
+    # archive sequentially
+    with openedArchiveOf(path) as archive:
+        for member, name in galleryMembersOf(archive):
+            if isinstance(archive, zipfile.ZipFile):
+                yield name, member.filename, archive.read(member)
+            else:
+                with archive.extractfile(member) as file:
+                    yield name, member.name, file.read()
+
+
+def cachedArchiveOf(path):
+    if path not in openArchives:
+        openArchives[path] = openedArchiveOf(path)
+        if len(openArchives) > MAX_OPEN_ARCHIVES:
+            _, archive = openArchives.popitem(last=False)
+            archive.close()
+
+    openArchives.move_to_end(path)
+    return openArchives[path]
+
+
+def memberContentOf(path, name):
+    # random access, so compressed tar archives get decompressed up to the member every time
+    with archivesLock:
+        archive = cachedArchiveOf(path)
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.read(name)
+
+        with archive.extractfile(name) as file:
+            return file.read()
+
+
+def closeArchive(path):
+    # once the archive is gone, e.g. a deleted upload
+    with archivesLock:
+        archive = openArchives.pop(path, None)
+        if archive is not None:
+            archive.close()
@@ -0,0 +1,128 @@
+import numpy, warnings
+
+from munkres import Munkres
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+MISSING_DISTANCE = 64.0  # distance assumed for every pair dropped for being above the threshold
+EDGE_BACKENDS = [
+    "sparse",
+    "greedy",
+]  # the ones solving candidate graphs, i.e. close pairs alone
+
+
+def munkresAssignment(distances, threshold):
+    if distances.size == 0:
+        return []
+
+    return [
+        (row, column)
+        for row, column in Munkres().compute(distances.tolist())
+        if distances[row][column] <= threshold
+    ]
+
+
+def denseAssignment(distances, threshold):
+    # same optimum as Munkres, solved by a shortest augmenting path (Jonker-Volgenant) solver
+    if distances.size == 0:
+        return []
+
+    rows, columns = linear_sum_assignment(distances)
+
+    return [
+        (row, column)
+        for row, column in zip(rows.tolist(), columns.tolist())
+        if distances[row][column] <= threshold
+    ]
+
+
+def edgesOf(distances, threshold):
+    rows, columns = numpy.nonzero(distances <= threshold)
+
+    return rows, columns, distances[rows, columns]
+
+
+def sparseEdgeAssignment(rows, columns, distances, shape, missingDistance=MISSING_DISTANCE):
+    # every dropped pair costs the same missingDistance, so the assignment of each connected
+    # component of the remaining edges no longer depends on the rest of the matrix
+    if len(distances) == 0:
+        return []
+
+    rowCount, columnCount = shape
+    graph = coo_matrix(
+        (numpy.ones(len(distances)), (rows, rowCount + columns)),
+        shape=(rowCount + columnCount, rowCount + columnCount),
+    )
+    _, labels = connected_components(graph, directed=False)
+    edgeLabels = labels[rows]
+
+    assignment = []
+    order = numpy.argsort(edgeLabels, kind="stable")
+    boundaries = numpy.flatnonzero(numpy.diff(edgeLabels[order])) + 1
+    for component in numpy.split(order, boundaries):
+        componentRows, rowIndexes = numpy.unique(rows[component], return_inverse=True)
+        componentColumns, columnIndexes = numpy.unique(columns[component], return_inverse=True)
+        if len(component) == 1:
+            assignment.append((int(componentRows[0]), int(componentColumns[0])))
+            continue
+
+        componentDistances = numpy.full(
+            (len(componentRows), len(componentColumns)), missingDistance
+        )
+        componentDistances[rowIndexes, columnIndexes] = distances[component]
+        for row, column in zip(*linear_sum_assignment(componentDistances)):
+            if componentDistances[row][column] < missingDistance:
+                assignment.append((int(componentRows[row]), int(componentColumns[column])))
+
+    return assignment
+
+
+def sparseAssignment(distances, threshold, missingDistance=MISSING_DISTANCE):
+    rows, columns, edgeDistances = edgesOf(distances, threshold)
+
+    return sparseEdgeAssignment(rows, columns, edgeDistances, distances.shape, missingDistance)
+
+
+def greedyEdgeAssignment(rows, columns, distances):
+    # repeatedly keeps the pairs that are each other's nearest neighbour; the closest remaining
+    # pair always is one of them, so every round makes progress
+    assignment = []
+    while len(distances) > 0:
+        byRow = numpy.lexsort((columns, rows, distances))
+        byColumn = numpy.lexsort((rows, columns, distances))
+        _, firstOfRow = numpy.unique(rows[byRow], return_index=True)
+        _, firstOfColumn = numpy.unique(columns[byColumn], return_index=True)
+        mutual = numpy.intersect1d(byRow[firstOfRow], byColumn[firstOfColumn])
+
+        assignment.extend(zip(rows[mutual].tolist(), columns[mutual].tolist()))
+        remaining = ~(numpy.isin(rows, rows[mutual]) | numpy.isin(columns, columns[mutual]))
+        rows, columns, distances = rows[remaining], columns[remaining], distances[remaining]
+
+    return assignment
+
+
+def greedyAssignment(distances, threshold):
+    return greedyEdgeAssignment(*edgesOf(distances, threshold))
+
+
+ASSIGNMENT_BACKENDS = {
+    "munkres": munkresAssignment,
+    "dense": denseAssignment,
+    "sparse": sparseAssignment,
+    "greedy": greedyAssignment,
+}
+
+
+def edgeAssignment(rows, columns, distances, shape, assignmentBackend):
+    # candidate graphs only hold the pairs within the threshold, while the optimum of the dense
+    # solvers depends on the ones above it too, so they get solved component by component
+    if assignmentBackend == "greedy":
+        return greedyEdgeAssignment(rows, columns, distances)
+    if assignmentBackend not in EDGE_BACKENDS:
+        warnings.warn(
+            f"The {assignmentBackend} assignment needs the whole distance matrix, "
+            "solving the candidate pairs with the sparse one instead"
+        )
+
+    return sparseEdgeAssignment(rows, columns, distances, shape)
@@ -0,0 +1,103 @@
+import argparse, functools, json, os, sys
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matching.assignment import ASSIGNMENT_BACKENDS
+from matching.cache import FINGERPRINT_CACHE_MAX_BYTES, MemoryFingerprintCache
+from matching.index import (
+    ASSIGNMENT_BACKEND,
+    CASCADE_STAGES,
+    cascadeChangelist,
+    fingerprintReference,
+    isGallerySource,
+    loadGallery,
+)
+
+BATCH_WORKERS = cpu_count()  # targets diffed at once, all of them hashing on the worker pool
+
+
+def targetChangelistOf(referenceGallery, fingerprintCache, stages, assignmentBackend, folder):
+    # every target works on its own copy of the reference images
+    return cascadeChangelist(
+        [dict(image) for image in referenceGallery],
+        loadGallery(folder, lazy=True),
+        stages,
+        fingerprintCache,
+        assignmentBackend,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Computes the changelist between a photo gallery and each of many others"
+    )
+    parser.add_argument("referenceFolder")
+    parser.add_argument("targetFolders", nargs="+")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=BATCH_WORKERS,
+        help="number of targets diffed at once",
+    )
+    parser.add_argument(
+        "--output",
+        help="folder to write one <target folder name>.json changelist per target into, "
+        "instead of printing them as JSON lines",
+    )
+    parser.add_argument(
+        "--assignment",
+        choices=sorted(ASSIGNMENT_BACKENDS),
+        default=ASSIGNMENT_BACKEND,
+        help="solver used to pair reference images with target images",
+    )
+    parser.add_argument(
+        "--stages",
+        type=lambda stages: stages.split(","),
+        default=CASCADE_STAGES,
+        help=f"comma-separated matching stages, run in order (default: {','.join(CASCADE_STAGES)})",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="print the number of pairs each stage looked at and resolved to stderr",
+    )
+    arguments = parser.parse_args()
+
+    folders = [arguments.referenceFolder, *arguments.targetFolders]
+    if not all(isGallerySource(folder) for folder in folders):
+        print(
+            'Usage: time python src/matching/batch.py "/code/samples/001 - gin/original" "/code/samples/001 - gin/attack"*'
+        )
+        exit(-1)
+
+    # the reference gets hashed once, its fingerprints staying in memory for every target
+    fingerprintCache = MemoryFingerprintCache(FINGERPRINT_CACHE_MAX_BYTES)
+    referenceGallery = loadGallery(os.path.normpath(arguments.referenceFolder), lazy=True)
+    fingerprintReference(referenceGallery, fingerprintCache, arguments.stages)
+
+    targetFolders = [os.path.normpath(folder) for folder in arguments.targetFolders]
+    if arguments.output is not None:
+        os.makedirs(arguments.output, exist_ok=True)
+
+    with ThreadPoolExecutor(arguments.workers) as executor:
+        results = executor.map(
+            functools.partial(
+                targetChangelistOf,
+                referenceGallery,
+                fingerprintCache,
+                arguments.stages,
+                arguments.assignment,
+            ),
+            targetFolders,
+        )
+        for targetFolder, (changelist, report) in zip(targetFolders, results):
+            if arguments.output is not None:
+                path = os.path.join(arguments.output, f"{os.path.basename(targetFolder)}.json")
+                with open(path, "w") as file:
+                    json.dump(changelist, file, indent=4)
+            else:
+                print(json.dumps({"target": targetFolder, "changelist": changelist}))
+            if arguments.report:
+                print(json.dumps({"target": targetFolder, "report": report}), file=sys.stderr)
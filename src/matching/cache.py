@@ -0,0 +1,114 @@
+import collections, io, sqlite3, threading, time
+import numpy
+
+FINGERPRINT_CACHE_FILENAME = ".fingerprints.sqlite"  # lives inside the gallery folder
+FINGERPRINT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # least recently used ones get evicted above it
+
+
+class FingerprintCache:
+    def __init__(self, path, maxBytes=FINGERPRINT_CACHE_MAX_BYTES):
+        self.maxBytes = maxBytes
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                digest TEXT NOT NULL,
+                parameters TEXT NOT NULL,
+                fingerprint BLOB NOT NULL,
+                lastUsed REAL NOT NULL,
+                PRIMARY KEY (digest, parameters)
+            )
+            """
+        )
+
+    def get(self, digest, parameters):
+        row = self.connection.execute(
+            "SELECT fingerprint FROM fingerprints WHERE digest = ? AND parameters = ?",
+            (digest, parameters),
+        ).fetchone()
+        if row is None:
+            return None
+
+        self.connection.execute(
+            "UPDATE fingerprints SET lastUsed = ? WHERE digest = ? AND parameters = ?",
+            (time.time(), digest, parameters),
+        )
+        return numpy.load(io.BytesIO(row[0]), allow_pickle=False)
+
+    def put(self, digest, parameters, fingerprint):
+        buffer = io.BytesIO()
+        numpy.save(buffer, fingerprint, allow_pickle=False)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+            (digest, parameters, buffer.getvalue(), time.time()),
+        )
+
+    def evict(self):
+        # keeps the most recently used fingerprints whose cumulated size fits in maxBytes
+        self.connection.execute(
+            """
+            DELETE FROM fingerprints WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid, SUM(LENGTH(fingerprint)) OVER (
+                        ORDER BY lastUsed DESC, rowid DESC
+                    ) AS cumulatedBytes
+                    FROM fingerprints
+                )
+                WHERE cumulatedBytes > ?
+            )
+            """,
+            (self.maxBytes,),
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+
+class MemoryFingerprintCache:
+    # same interface as FingerprintCache, for long-running processes sharing it between threads
+    def __init__(self, maxBytes=FINGERPRINT_CACHE_MAX_BYTES):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.fingerprints = collections.OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, digest, parameters):
+        with self.lock:
+            fingerprint = self.fingerprints.get((digest, parameters))
+            if fingerprint is not None:
+                self.fingerprints.move_to_end((digest, parameters))
+
+            return fingerprint
+
+    def put(self, digest, parameters, fingerprint):
+        fingerprint = numpy.array(fingerprint)
+        fingerprint.setflags(write=False)  # handed out as is to every thread reading it
+        with self.lock:
+            if (digest, parameters) in self.fingerprints:
+                self.size -= self.fingerprints.pop((digest, parameters)).nbytes
+            self.fingerprints[(digest, parameters)] = fingerprint
+            self.size += fingerprint.nbytes
+            self.evict()
+
+    def entriesOf(self, digests):
+        # the (digest, parameters, fingerprint) entries of these digests, to hand them over
+        with self.lock:
+            return [
+                (digest, parameters, fingerprint)
+                for (digest, parameters), fingerprint in self.fingerprints.items()
+                if digest in digests
+            ]
+
+    def evict(self):
+        # drops the least recently used fingerprints until the rest fits in maxBytes
+        with self.lock:
+            while self.size > self.maxBytes:
+                _, fingerprint = self.fingerprints.popitem(last=False)
+                self.size -= fingerprint.nbytes
+
+    def close(self):
+        with self.lock:
+            self.fingerprints.clear()
+            self.size = 0
@@ -0,0 +1,95 @@
+import itertools
+import numpy
+
+CHUNK_BITS = 16  # a 64-bit hash gets indexed as 4 substrings of 16 bits
+QUERY_BATCH_SIZE = 1024  # queries probed at once; bounds the memory used by the probe arrays
+
+
+def bitCountsOf(words):
+    return numpy.unpackbits(words.view(numpy.uint8)).reshape(len(words), -1).sum(axis=1)
+
+
+def neighbourMasksOf(radius, bits=CHUNK_BITS):
+    # every value within the given hamming radius of 0, i.e. the XOR masks to probe with
+    return numpy.array(
+        [
+            sum(1 << bit for bit in flippedBits)
+            for distance in range(radius + 1)
+            for flippedBits in itertools.combinations(range(bits), distance)
+        ],
+        dtype=numpy.int64,
+    )
+
+
+def chunksOf(hashes):
+    shifts = numpy.arange(0, 64, CHUNK_BITS, dtype=numpy.uint64)
+
+    return ((hashes[:, numpy.newaxis] >> shifts) & numpy.uint64((1 << CHUNK_BITS) - 1)).astype(
+        numpy.int64
+    )
+
+
+class MultiIndexHash:
+    # multi-index hashing over 64-bit hashes: if 2 hashes are within radius r, then at least one
+    # of their m substrings is within floor(r / m), so probing every substring table around the
+    # query's substrings finds every candidate without scanning the whole gallery
+    def __init__(self, hashes):
+        self.hashes = hashes
+        chunks = chunksOf(hashes)
+        self.orders = [numpy.argsort(chunk, kind="stable") for chunk in chunks.T]
+        # bucketStarts[value] is where the hashes with that substring start in the sorted order
+        self.bucketStarts = [
+            numpy.concatenate(
+                [[0], numpy.cumsum(numpy.bincount(chunk, minlength=1 << CHUNK_BITS))]
+            )
+            for chunk in chunks.T
+        ]
+
+    def search(self, queries, radius):
+        masks = neighbourMasksOf(int(radius) // len(self.orders))
+
+        queryIndexes, hashIndexes, distances = [], [], []
+        for start in range(0, len(queries), QUERY_BATCH_SIZE):
+            batchQueries, batchHashes, batchDistances = self.searchBatch(
+                queries[start : start + QUERY_BATCH_SIZE], radius, masks
+            )
+            queryIndexes.append(batchQueries + start)
+            hashIndexes.append(batchHashes)
+            distances.append(batchDistances)
+
+        if len(queryIndexes) == 0 or len(self.hashes) == 0:
+            return tuple(numpy.empty(0, dtype=numpy.int64) for _ in range(3))
+
+        return (
+            numpy.concatenate(queryIndexes),
+            numpy.concatenate(hashIndexes),
+            numpy.concatenate(distances),
+        )
+
+    def searchBatch(self, queries, radius, masks):
+        queryChunks = chunksOf(queries)
+
+        queryIndexes, hashIndexes = [], []
+        for chunkIndex, (order, bucketStarts) in enumerate(zip(self.orders, self.bucketStarts)):
+            probes = (
+                queryChunks[:, chunkIndex, numpy.newaxis] ^ masks[numpy.newaxis, :]
+            ).ravel()
+            lefts = bucketStarts[probes]
+            counts = bucketStarts[probes + 1] - lefts
+
+            # expands every [left, right) range of the sorted table into its positions
+            offsets = numpy.arange(counts.sum()) - numpy.repeat(
+                numpy.cumsum(counts) - counts, counts
+            )
+            queryIndexes.append(numpy.repeat(numpy.arange(probes.size) // len(masks), counts))
+            hashIndexes.append(order[numpy.repeat(lefts, counts) + offsets])
+
+        queryIndexes = numpy.concatenate(queryIndexes)
+        hashIndexes = numpy.concatenate(hashIndexes)
+        pairs = numpy.unique(queryIndexes * len(self.hashes) + hashIndexes)
+        queryIndexes, hashIndexes = pairs // len(self.hashes), pairs % len(self.hashes)
+
+        distances = bitCountsOf(queries[queryIndexes] ^ self.hashes[hashIndexes])
+        withinRadius = distances <= radius
+
+        return queryIndexes[withinRadius], hashIndexes[withinRadius], distances[withinRadius]
@@ -0,0 +1,8 @@
+import json, os
+
+
+def saveJson(path, value, **options):
+    # written aside first, so that an interrupted run never leaves half a file behind
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(value, file, **options)
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,103 @@
+import imagehash, numpy, scipy.fftpack
+
+from cv2 import cv2
+from PIL import Image
+
+HASH_SIZE = 8  # imagehash.phash's default hash_size
+PHASH_INPUT_SIZE = 32  # imagehash.phash's hash_size * highfreq_factor
+FLIP_SIGNS = (-1.0) ** numpy.arange(HASH_SIZE)
+DCT_MATRIX = 2 * numpy.cos(
+    numpy.pi
+    * numpy.arange(HASH_SIZE)[:, numpy.newaxis]
+    * (2 * numpy.arange(PHASH_INPUT_SIZE) + 1)
+    / (2 * PHASH_INPUT_SIZE)
+)  # the lowest frequency rows of scipy.fftpack.dct's (unnormalized) DCT-II
+MEDIAN_TIE_TOLERANCE = 1e-6  # way above the rounding differences between both DCTs
+PHASH_BATCH_SIZE = 4096  # inputs transformed at once, 8KB each
+
+
+def pHashInputOf(image):
+    # the grayscale thumbnail imagehash.phash computes its DCT on
+    return numpy.asarray(
+        image.convert("L").resize((PHASH_INPUT_SIZE, PHASH_INPUT_SIZE), Image.LANCZOS)
+    )
+
+
+def pHashInputsOf(images):
+    return numpy.stack(
+        [pHashInputOf(Image.fromarray(image)).astype(numpy.float64) for image in images]
+    ).reshape(-1, PHASH_INPUT_SIZE, PHASH_INPUT_SIZE)
+
+
+def rotatedInputsOf(inputs, angle):
+    # same rotation as albumentations.Rotate, only applied on the thumbnails
+    matrix = cv2.getRotationMatrix2D((PHASH_INPUT_SIZE / 2, PHASH_INPUT_SIZE / 2), angle, 1.0)
+
+    return numpy.stack(
+        [
+            cv2.warpAffine(
+                pixels,
+                matrix,
+                (PHASH_INPUT_SIZE, PHASH_INPUT_SIZE),
+                flags=cv2.INTER_LINEAR,
+                borderMode=cv2.BORDER_REFLECT_101,
+            )
+            for pixels in inputs
+        ]
+    ).reshape(inputs.shape)
+
+
+def middleGapsOf(lowFrequencies):
+    # gap between the two coefficients the median of each hash gets averaged from
+    coefficients = numpy.sort(lowFrequencies.reshape(len(lowFrequencies), -1), axis=1)
+    middle = coefficients.shape[1] // 2
+
+    return coefficients[:, middle] - coefficients[:, middle - 1]
+
+
+def lowFrequenciesOf(inputs):
+    # the DCT of every input at once, as DCT_MATRIX @ input @ DCT_MATRIX.T, only computing the
+    # frequencies pHash keeps
+    lowFrequencies = DCT_MATRIX @ inputs @ DCT_MATRIX.T
+
+    # bits can only differ from imagehash.phash's when the middle coefficients (nearly) tie, as
+    # with flat images, so those inputs go through scipy's DCT like imagehash.phash does
+    ambiguous = numpy.flatnonzero(
+        numpy.minimum(
+            middleGapsOf(lowFrequencies),
+            middleGapsOf(flippedLowFrequenciesOf(lowFrequencies)),
+        )
+        <= MEDIAN_TIE_TOLERANCE
+    )
+    if len(ambiguous) > 0:
+        lowFrequencies[ambiguous] = scipy.fftpack.dct(
+            scipy.fftpack.dct(inputs[ambiguous], axis=1), axis=2
+        )[:, :HASH_SIZE, :HASH_SIZE]
+
+    return lowFrequencies
+
+
+def flippedLowFrequenciesOf(lowFrequencies):
+    # mirroring an image horizontally only flips the sign of its odd horizontal frequencies
+    return lowFrequencies * FLIP_SIGNS
+
+
+def pHashBitsOf(lowFrequencies):
+    coefficients = lowFrequencies.reshape(len(lowFrequencies), -1)
+
+    return coefficients > numpy.median(coefficients, axis=1)[:, numpy.newaxis]
+
+
+def packedPHashesOf(lowFrequencies):
+    return numpy.packbits(pHashBitsOf(lowFrequencies), axis=1).view(numpy.uint64)[:, 0]
+
+
+def batchedPHashesOf(inputs):
+    # imagehash.phash of every 32x32 input, bit for bit, computed PHASH_BATCH_SIZE at a time
+    hashes = []
+    for first in range(0, len(inputs), PHASH_BATCH_SIZE):
+        batch = numpy.stack(inputs[first : first + PHASH_BATCH_SIZE]).astype(numpy.float64)
+        bits = pHashBitsOf(lowFrequenciesOf(batch)).reshape(-1, HASH_SIZE, HASH_SIZE)
+        hashes += [imagehash.ImageHash(imageBits) for imageBits in bits]
+
+    return hashes
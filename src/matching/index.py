@@ -1,59 +1,338 @@
-import os, sys
-import albumentations, imagehash
+import argparse, cProfile, collections, functools, hashlib, importlib, io, itertools, json, os
+import sys, time
+import albumentations, imagehash, numpy
 
 from cv2 import cv2
 from PIL import Image
-from munkres import Munkres
-from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matching.archives import archiveMembersOf, isArchive, memberContentOf
+from matching.assignment import ASSIGNMENT_BACKENDS, EDGE_BACKENDS, edgeAssignment
+from matching.cache import (
+    FINGERPRINT_CACHE_FILENAME,
+    FINGERPRINT_CACHE_MAX_BYTES,
+    FingerprintCache,
+    MemoryFingerprintCache,
+)
+from matching.candidates import MultiIndexHash
+from matching.geometry import (
+    batchedPHashesOf,
+    flippedLowFrequenciesOf,
+    lowFrequenciesOf,
+    packedPHashesOf,
+    pHashInputOf,
+    pHashInputsOf,
+    rotatedInputsOf,
+)
+from matching.manifest import changedFilenamesOf, loadManifest, saveManifest
+from matching.profiling import (
+    profiled,
+    profiledCount,
+    profiledStage,
+    startProfiling,
+    stopProfiling,
+)
+from matching.scheduler import loadStatistics, recordReport, saveStatistics, scheduledStagesOf
+from matching.segments import cropResistantHashesOf, multiHashDistancesBetween
+from matching.sinks import CHANGE_FORMATS, changeSinkOf
+from matching.stages import STAGE_REGISTRY, cacheKeyOf, registerStage, registeredStageOf
+from matching.tiles import TILE_MEMORY_BUDGET, tiledDistancesOf, topCandidatesOf
+from matching.workers import SharedImages, workerEngine
 
 IMAGE_RESIZE_TARGET = 512  # so that we don't run out of memory
 MAX_HAMMING_DIST = 64.0  # maximum possible hamming distance of any 2 64-bit hashes
 PHASH_THRESHOLD = 12.0  # any hamming distance above this value is produced by different images in pHash's context
 CROP_THRESHOLD = 0.09  # any hamming distance above this values produced by different images in cropResistantHash's context
 MAX_ANGLE = 30  # maximum rotation angle supported; any image rotated above this value will not get matched with its regular version
+COLOR_PREFILTER_THRESHOLD = 40.0  # global colorhash distance (out of 112 bits) above which no attack in the samples landed
+WHASH_THRESHOLD = 2.0  # no false match on the samples, though only half the attacks within it
+DHASH_THRESHOLD = 2.0  # 3/4 of the sample attacks within it, for 1 in 200 different pairs
+AHASH_THRESHOLD = 1.0  # 3/4 of the sample attacks within it, and no different pair
+CASCADE_STAGES = ["exact", "pHash", "colorPrefilter", "cropResistantHash"]  # cheapest first
+STAGE_COSTS = {  # seconds per pair of each stage on its own, on 5 x 5 sample images and 1 CPU
+    "exact": 3e-4,
+    "pHash": 2e-2,
+    "colorPrefilter": 5e-3,
+    "cropResistantHash": 0.16,
+    "wHash": 1.6e-2,
+    "dHash": 4e-3,
+    "aHash": 5e-3,
+}
+GEOMETRIC_SEARCH_STEPS = [15, 5]  # coarse to fine, the last one being the regular 5 degree grid
+ASSIGNMENT_BACKEND = "dense"  # one of ASSIGNMENT_BACKENDS; "munkres" is the pure-Python solver
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}  # JPEGs get downscaled in the DCT domain while decoding, way cheaper than a full decode
+DECODE_WORKERS = 2 * cpu_count()  # decoding is mostly spent in OpenCV, which releases the GIL
+STREAM_IN_FLIGHT = 64  # images decoded at once in streaming mode, ~0.75MB each
+POPCOUNT_TABLE = numpy.array([bin(byte).count("1") for byte in range(256)], dtype=numpy.uint8)
+IDENTITY_PIPELINE = albumentations.Compose([])
+BATCHED_HASH_FUNCTIONS = {
+    imagehash.phash: (pHashInputOf, batchedPHashesOf),
+}  # workers only compute their inputs, which then get hashed all at once
+RESIZE_PIPELINE = albumentations.Compose(
+    [
+        albumentations.Resize(
+            IMAGE_RESIZE_TARGET,
+            IMAGE_RESIZE_TARGET,
+            interpolation=cv2.INTER_LANCZOS4,
+        ),
+    ],
+)
 
 
-def loadGallery(folder):
-    resizePipeline = albumentations.Compose(
-        [
-            albumentations.Resize(
-                IMAGE_RESIZE_TARGET,
-                IMAGE_RESIZE_TARGET,
-                interpolation=cv2.INTER_LANCZOS4,
-            ),
-        ],
-    )
+def digestOf(path):
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def decodeFlagOf(path):
+    # the largest reduction that still leaves at least IMAGE_RESIZE_TARGET pixels on each side
+    try:
+        with Image.open(path) as image:
+            smallestSide = min(image.size)
+    except OSError:
+        return cv2.IMREAD_COLOR
+
+    for factor, flag in REDUCED_DECODE_FLAGS.items():
+        if smallestSide // factor >= IMAGE_RESIZE_TARGET:
+            return flag
+
+    return cv2.IMREAD_COLOR
+
+
+def resizedImageOf(content):
+    if content is None:
+        return None
+
+    profiledCount("imagesDecoded")
+    with profiledStage("resize"):
+        return RESIZE_PIPELINE(image=content)["image"]
+
+
+def decodedImageOf(path, reduced=False):
+    with profiledStage("decode"):
+        content = cv2.imread(path, decodeFlagOf(path) if reduced else cv2.IMREAD_COLOR)
+
+    return resizedImageOf(content)
+
+
+def decodedBufferOf(data, reduced=False):
+    # archive members get decoded straight from memory, never extracted to disk
+    if len(data) == 0:
+        return None
+
+    with profiledStage("decode"):
+        flag = decodeFlagOf(io.BytesIO(data)) if reduced else cv2.IMREAD_COLOR
+        content = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), flag)
+
+    return resizedImageOf(content)
+
+
+def decodingsOf(source, reduced=False):
+    # (filename, decoding) of every image of a folder or of a zip / tar archive, whose members
+    # keep their paths inside it as filenames
+    if isArchive(source):
+        for name, _, data in archiveMembersOf(source):
+            yield name, functools.partial(decodedBufferOf, data, reduced)
+        return
+
+    for filename in os.listdir(source):
+        yield filename, functools.partial(
+            decodedImageOf, os.path.join(source, filename), reduced
+        )
+
+
+def streamGallery(source, reduced=False, workers=DECODE_WORKERS):
+    # decodes on a thread pool and yields the images in order, keeping at most
+    # 2 images per worker in flight; archives get read on this thread meanwhile
+    decodings = decodingsOf(source, reduced)
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        while True:
+            for filename, decoding in itertools.islice(decodings, 2 * workers - len(pending)):
+                pending.append((filename, executor.submit(decoding)))
+            if len(pending) == 0:
+                return
+
+            filename, content = pending.popleft()
+            if content.result() is not None:
+                yield {"filename": filename, "content": content.result()}
+
+
+@profiled("load")
+def loadGallery(source, lazy=False, reduced=False):
+    if not lazy:
+        return list(streamGallery(source, reduced))
+
+    # lazy galleries are only decoded once a fingerprint is missing from the cache
+    if isArchive(source):
+        return [
+            {
+                "filename": name,
+                "archive": source,
+                "member": member,
+                "digest": hashlib.sha256(data).hexdigest(),
+                "reduced": reduced,
+            }
+            for name, member, data in archiveMembersOf(source)
+        ]
 
     gallery = []
-    for filename in os.listdir(folder):
-        content = cv2.imread(os.path.join(folder, filename))
-        if content is not None:
+    for filename in os.listdir(source):
+        path = os.path.join(source, filename)
+        if os.path.isfile(path) and cv2.haveImageReader(path):
             gallery.append(
                 {
                     "filename": filename,
-                    "content": resizePipeline(image=content)["image"],
+                    "path": path,
+                    "digest": digestOf(path),
+                    "reduced": reduced,
                 }
             )
 
     return gallery
 
 
-def transformedGallery(gallery, transformPipeline=albumentations.Compose([])):
-    return [
+def contentOf(image):
+    if "content" in image:
+        return image["content"]
+
+    if "archive" in image:
+        data = memberContentOf(image["archive"], image["member"])
+        image["content"] = decodedBufferOf(data, image["reduced"])
+    else:
+        image["content"] = decodedImageOf(image["path"], image["reduced"])
+
+    return image["content"]
+
+
+def isUndecodable(image):
+    # lazy images only find out once decoded, their content then staying None
+    return "content" in image and image["content"] is None
+
+
+def decodedContentsOf(images):
+    # lazy images get decoded on the thread pool too, as loading an eager gallery does
+    if len(images) == 0:
+        return []
+
+    with ThreadPoolExecutor(min(DECODE_WORKERS, len(images))) as executor:
+        return list(executor.map(contentOf, images))
+
+
+def isGallerySource(path):
+    return os.path.isdir(path) or isArchive(path)
+
+
+def fingerprintCachePathOf(source):
+    # archives can't hold their cache, which goes next to them instead
+    if os.path.isdir(source):
+        return os.path.join(source, FINGERPRINT_CACHE_FILENAME)
+
+    return source + FINGERPRINT_CACHE_FILENAME
+
+
+def hashParametersOf(hashFunction, transformPipeline, reduced=False):
+    # any change in these invalidates the fingerprints cached for the previous values
+    return json.dumps(
         {
-            "filename": image["filename"],
-            "content": Image.fromarray(transformPipeline(image=image["content"])["image"]),
-        }
-        for image in gallery
+            "hashFunction": cacheKeyOf(hashFunction),
+            "imagehash": imagehash.__version__,
+            "resize": [IMAGE_RESIZE_TARGET, "lanczos4", "reduced" if reduced else "full"],
+            "transformPipeline": albumentations.to_dict(transformPipeline),
+        },
+        sort_keys=True,
+    )
+
+
+def fingerprintOf(imageHash):
+    if isinstance(imageHash, imagehash.ImageMultiHash):
+        return numpy.stack([segmentHash.hash for segmentHash in imageHash.segment_hashes])
+
+    return imageHash.hash
+
+
+def imageHashOf(fingerprint):
+    if fingerprint.ndim == 3:
+        return imagehash.ImageMultiHash(
+            [imagehash.ImageHash(segment) for segment in fingerprint]
+        )
+
+    return imagehash.ImageHash(fingerprint)
+
+
+@profiled("hashing")
+def hashesOf(
+    gallery,
+    hashFunction,
+    transformPipelines=[IDENTITY_PIPELINE],
+    fingerprintCache=None,
+):
+    # returns the hash of every image of the gallery, for each of the transform pipelines
+    hashes = [[None] * len(gallery) for _ in transformPipelines]
+    if fingerprintCache is not None:
+        parameters = [
+            {
+                reduced: hashParametersOf(hashFunction, transformPipeline, reduced)
+                for reduced in [False, True]
+            }
+            for transformPipeline in transformPipelines
+        ]
+        for pipelineIndex, pipelineParameters in enumerate(parameters):
+            for index, image in enumerate(gallery):
+                if "digest" in image:
+                    fingerprint = fingerprintCache.get(
+                        image["digest"], pipelineParameters[image["reduced"]]
+                    )
+                    if fingerprint is not None:
+                        hashes[pipelineIndex][index] = imageHashOf(fingerprint)
+
+    missingTasks = [
+        (pipelineIndex, index)
+        for pipelineIndex, pipelineHashes in enumerate(hashes)
+        for index, imageHash in enumerate(pipelineHashes)
+        if imageHash is None
     ]
+    missingIndexes = sorted({index for _, index in missingTasks})
+    profiledCount("hashesCached", len(gallery) * len(transformPipelines) - len(missingTasks))
+    profiledCount("hashesComputed", len(missingTasks))
+    profiledCount("poolTasks", len(missingTasks))
+    sharedIndexes = {index: sharedIndex for sharedIndex, index in enumerate(missingIndexes)}
+    inputFunction, batchedHashFunction = BATCHED_HASH_FUNCTIONS.get(
+        hashFunction, (hashFunction, None)
+    )
+    # the pool has to exist before the block, or its workers would inherit a mapping of it
+    engine = workerEngine()
+    missingImages = [gallery[index] for index in missingIndexes]
+    with SharedImages(decodedContentsOf(missingImages)) as sharedImages:
+        computedHashes = engine.hashes(
+            sharedImages,
+            transformPipelines,
+            inputFunction,
+            [(pipelineIndex, sharedIndexes[index]) for pipelineIndex, index in missingTasks],
+        )
+    if batchedHashFunction is not None and len(computedHashes) > 0:
+        computedHashes = batchedHashFunction(computedHashes)
 
+    for (pipelineIndex, index), imageHash in zip(missingTasks, computedHashes):
+        hashes[pipelineIndex][index] = imageHash
+        if fingerprintCache is not None and "digest" in gallery[index]:
+            fingerprintCache.put(
+                gallery[index]["digest"],
+                parameters[pipelineIndex][gallery[index]["reduced"]],
+                fingerprintOf(imageHash),
+            )
 
-def hashDifferenceBetween(referenceImage, targetImage, hashFunction):
-    return (float)(hashFunction(referenceImage) - hashFunction(targetImage))
+    return hashes
 
 
-def hammingMatrixOf(referenceGallery, targetGallery, hashFunction, maxAngle=MAX_ANGLE):
-    targetPipelines = [
+def targetPipelinesOf(maxAngle):
+    return [
         *[
             albumentations.Compose(
                 [
@@ -73,106 +352,594 @@ def hammingMatrixOf(referenceGallery, targetGallery, hashFunction, maxAngle=MAX_
         ],
     ]
 
-    hashPool = Pool(cpu_count())
-    hashMatrix = [
+
+def packedHashOf(imageHash):
+    bits = imageHash.hash.flatten()
+    padding = numpy.zeros(-len(bits) % 64, dtype=bool)  # up to a whole number of 64-bit words
+
+    return numpy.packbits(numpy.concatenate([bits, padding])).view(numpy.uint64)
+
+
+def packedHashesOf(hashes):
+    return numpy.stack([packedHashOf(imageHash) for imageHash in hashes])
+
+
+def popcountDistancesBetween(referenceHashes, targetHashes):
+    # referenceHashes is R x W and targetHashes is P x T x W, both made of uint64 words
+    differentBits = numpy.bitwise_xor(
+        referenceHashes[:, numpy.newaxis, numpy.newaxis, :],
+        targetHashes[numpy.newaxis, :, :, :],
+    )
+
+    return POPCOUNT_TABLE[differentBits.view(numpy.uint8)].sum(axis=-1)
+
+
+def packedFingerprintsOf(
+    referenceGallery, targetGallery, hashFunction, maxAngle=MAX_ANGLE, fingerprintCache=None
+):
+    referenceHashes = packedHashesOf(
+        hashesOf(referenceGallery, hashFunction, fingerprintCache=fingerprintCache)[0]
+    )
+    targetHashes = numpy.stack(
         [
-            [
-                hashPool.apply_async(
-                    hashDifferenceBetween,
-                    (referenceImage["content"], targetImage["content"], hashFunction),
-                )
-                for targetImage in transformedGallery(targetGallery, targetPipeline)
-            ]
-            for targetPipeline in targetPipelines
+            packedHashesOf(pipelineHashes)
+            for pipelineHashes in hashesOf(
+                targetGallery, hashFunction, targetPipelinesOf(maxAngle), fingerprintCache
+            )
         ]
-        for referenceImage in transformedGallery(referenceGallery)
-    ]
+    )
 
-    hashPool.close()
-    hashPool.join()
+    return referenceHashes, targetHashes
 
-    hammingMatrix = [
-        [{"distance": MAX_HAMMING_DIST} for _ in range(len(targetGallery))]
-        for _ in range(len(referenceGallery))
+
+def vectorizedTilesOf(
+    referenceGallery, targetGallery, hashFunction, maxAngle=MAX_ANGLE, fingerprintCache=None
+):
+    referenceHashes, targetHashes = packedFingerprintsOf(
+        referenceGallery, targetGallery, hashFunction, maxAngle, fingerprintCache
+    )
+
+    def distancesOf(referenceSlice, targetSlice):
+        # R x P x T distances, of which we only keep the best rotation / flip of every target
+        return (
+            popcountDistancesBetween(
+                referenceHashes[referenceSlice], targetHashes[:, targetSlice]
+            )
+            .min(axis=1)
+            .astype(numpy.uint8)
+        )
+
+    # the XOR-ed words, their byte popcounts and the sum of every rotation / flip
+    pipelineCount, _, wordCount = targetHashes.shape
+    return distancesOf, pipelineCount * (16 * wordCount + 8)
+
+
+def popcountsOf(words):
+    return POPCOUNT_TABLE[words.view(numpy.uint8)].reshape(*words.shape, -1).sum(axis=-1)
+
+
+def geometricTilesOf(referenceGallery, targetGallery, threshold, maxAngle=MAX_ANGLE):
+    # pHash distances where rotations and flips are applied on the 32x32 pHash inputs (flips even
+    # straight on their DCT), and only the pairs above the threshold at 0 degrees search for
+    # a better angle, from coarse to fine
+    referenceHashes = packedPHashesOf(
+        lowFrequenciesOf(pHashInputsOf([contentOf(image) for image in referenceGallery]))
+    )
+    targetInputs = pHashInputsOf([contentOf(image) for image in targetGallery])
+    targetHashes = {}  # angle -> T x 2 hashes, as they are and flipped
+
+    def distancesAt(angle, referenceIndexes, targetIndexes):
+        if angle not in targetHashes:
+            lowFrequencies = lowFrequenciesOf(
+                targetInputs if angle == 0 else rotatedInputsOf(targetInputs, angle)
+            )
+            targetHashes[angle] = numpy.stack(
+                [
+                    packedPHashesOf(lowFrequencies),
+                    packedPHashesOf(flippedLowFrequenciesOf(lowFrequencies)),
+                ],
+                axis=1,
+            )
+
+        differentBits = referenceHashes[referenceIndexes, numpy.newaxis] ^ (
+            targetHashes[angle][targetIndexes]
+        )
+        return popcountsOf(differentBits).min(axis=1)
+
+    def distancesOf(referenceSlice, targetSlice):
+        referenceIndexes, targetIndexes = [
+            indexes.ravel() for indexes in numpy.mgrid[referenceSlice, targetSlice]
+        ]
+        distances = distancesAt(0, referenceIndexes, targetIndexes)
+        bestAngles = numpy.zeros(len(distances), dtype=numpy.int64)
+
+        searchRange = maxAngle
+        for step in GEOMETRIC_SEARCH_STEPS:
+            pending = numpy.flatnonzero(distances > threshold)
+            centers = bestAngles[pending]
+            for multiple in range(1, searchRange // step + 1):
+                for offset in [-multiple * step, multiple * step]:
+                    angles = centers + offset
+                    for angle in numpy.unique(angles[numpy.abs(angles) <= maxAngle]).tolist():
+                        selected = pending[angles == angle]
+                        candidateDistances = distancesAt(
+                            angle, referenceIndexes[selected], targetIndexes[selected]
+                        )
+                        better = candidateDistances < distances[selected]
+                        distances[selected[better]] = candidateDistances[better]
+                        bestAngles[selected[better]] = angle
+
+            # the next step only explores between the angles this one already tried
+            searchRange = step - 1
+
+        return distances.reshape(
+            referenceSlice.stop - referenceSlice.start, targetSlice.stop - targetSlice.start
+        ).astype(numpy.uint8)
+
+    return distancesOf, 128  # indexes, distances, angles and XOR-ed words of every pair
+
+
+@profiled("assignment")
+def edgeMatchesOf(
+    referenceGallery,
+    targetGallery,
+    rows,
+    columns,
+    distances,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+):
+    edgeDistances = {
+        (row, column): distance
+        for row, column, distance in zip(rows.tolist(), columns.tolist(), distances.tolist())
+    }
+
+    return [
+        {
+            "distance": float(edgeDistances[(row, column)]),
+            "reference": referenceGallery[row]["filename"],
+            "target": targetGallery[column]["filename"],
+        }
+        for row, column in edgeAssignment(
+            rows,
+            columns,
+            distances,
+            (len(referenceGallery), len(targetGallery)),
+            assignmentBackend,
+        )
     ]
-    for referenceIndex, referenceImage in enumerate(referenceGallery):
-        for pipelineIndex, _ in enumerate(targetPipelines):
-            for targetIndex, targetImage in enumerate(targetGallery):
-                potentialDistance = hashMatrix[referenceIndex][pipelineIndex][targetIndex].get()
-                currentDistance = hammingMatrix[referenceIndex][targetIndex]["distance"]
-                if potentialDistance < currentDistance:
-                    hammingMatrix[referenceIndex][targetIndex] = {
-                        "distance": potentialDistance,
-                        "reference": referenceImage["filename"],
-                        "target": targetImage["filename"],
-                    }
 
-    return hammingMatrix
 
+def candidateMatchesOf(
+    referenceGallery,
+    targetGallery,
+    hashFunction,
+    threshold,
+    maxAngle=MAX_ANGLE,
+    fingerprintCache=None,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+):
+    # only looks at the pairs within the threshold instead of building the whole matrix,
+    # which requires the hash function to produce 64-bit hashes (e.g. pHash)
+    if len(referenceGallery) == 0 or len(targetGallery) == 0:
+        return []
+
+    referenceHashes, targetHashes = packedFingerprintsOf(
+        referenceGallery, targetGallery, hashFunction, maxAngle, fingerprintCache
+    )
+    if referenceHashes.shape[1] != 1:
+        raise ValueError("Candidate search only supports 64-bit hashes")
+
+    variantIndexes, referenceIndexes, distances = MultiIndexHash(referenceHashes[:, 0]).search(
+        targetHashes.reshape(-1), threshold
+    )
+    targetIndexes = variantIndexes % len(targetGallery)
 
-def pHashMatch(referenceGallery, targetGallery):
-    hammingMatrix = hammingMatrixOf(referenceGallery, targetGallery, imagehash.phash)
-    munkresMatrix = [[column["distance"] for column in row] for row in hammingMatrix]
-    optimalMatches = [
-        hammingMatrix[row][column] for row, column in Munkres().compute(munkresMatrix)
+    # every target shows up once per rotation / flip, of which only the closest one is kept
+    order = numpy.lexsort((distances, targetIndexes, referenceIndexes))
+    referenceIndexes, targetIndexes = referenceIndexes[order], targetIndexes[order]
+    distances = distances[order].astype(numpy.float64)
+    _, closest = numpy.unique(
+        referenceIndexes * len(targetGallery) + targetIndexes, return_index=True
+    )
+    profiledCount("candidatePairs", len(closest))
+
+    return edgeMatchesOf(
+        referenceGallery,
+        targetGallery,
+        referenceIndexes[closest],
+        targetIndexes[closest],
+        distances[closest],
+        assignmentBackend,
+    )
+
+
+@profiled("assignment")
+def optimalMatchesOf(
+    distances, referenceGallery, targetGallery, threshold, assignmentBackend=ASSIGNMENT_BACKEND
+):
+    if distances.size == 0:
+        return []
+
+    return [
+        {
+            "distance": float(distances[row][column]),
+            "reference": referenceGallery[row]["filename"],
+            "target": targetGallery[column]["filename"],
+        }
+        for row, column in ASSIGNMENT_BACKENDS[assignmentBackend](distances, threshold)
     ]
 
-    return list(filter(lambda match: match["distance"] <= PHASH_THRESHOLD, optimalMatches))
 
+def tiledMatchesOf(
+    referenceGallery,
+    targetGallery,
+    tiles,
+    threshold,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    topCandidates=None,
+    memoryBudget=TILE_MEMORY_BUDGET,
+):
+    # either solves the whole matrix, or only the topCandidates closest targets of every
+    # reference, which never needs more than a tile of distances at once
+    distancesOf, bytesPerPair = tiles
+    shape = (len(referenceGallery), len(targetGallery))
+    profiledCount("matrixCells", shape[0] * shape[1])
+    if topCandidates is None:
+        with profiledStage("distances"):
+            distances = tiledDistancesOf(*shape, distancesOf, bytesPerPair, memoryBudget)
+        return optimalMatchesOf(
+            distances, referenceGallery, targetGallery, threshold, assignmentBackend
+        )
 
-def colorHashWith8Binbits(image):
-    return imagehash.crop_resistant_hash(
+    with profiledStage("distances"):
+        candidates = topCandidatesOf(
+            *shape, distancesOf, threshold, topCandidates, bytesPerPair, memoryBudget
+        )
+    return edgeMatchesOf(referenceGallery, targetGallery, *candidates, assignmentBackend)
+
+
+def segmentedColorHashes(image):
+    # the crop-resistant colorhashes with 8 and 12 binbits, computed on the same segments and
+    # stored side by side in each segment hash (14 x (8 + 12) bits)
+    hashes = cropResistantHashesOf(
         image,
-        hash_func=lambda image: imagehash.colorhash(image, binbits=8),
+        [
+            functools.partial(imagehash.colorhash, binbits=8),
+            functools.partial(imagehash.colorhash, binbits=12),
+        ],
     )
 
+    return imagehash.ImageMultiHash(
+        [
+            imagehash.ImageHash(numpy.concatenate([hash8.hash, hash12.hash], axis=1))
+            for hash8, hash12 in zip(*[multiHash.segment_hashes for multiHash in hashes])
+        ]
+    )
 
-def colorHashWith12Binbits(image):
-    return imagehash.crop_resistant_hash(
-        image,
-        hash_func=lambda image: imagehash.colorhash(image, binbits=12),
+
+def segmentBitsOf(multiHash, binbits):
+    return numpy.stack(
+        [segmentHash.hash[:, binbits].flatten() for segmentHash in multiHash.segment_hashes]
     )
 
 
-def averagedMatrices(matrices):
-    if len(matrices) == 0:
-        return []
+def cropResistantTilesOf(
+    referenceGallery,
+    targetGallery,
+    hashFunction=segmentedColorHashes,
+    maxAngle=0,
+    fingerprintCache=None,
+):
+    # hashFunction has to lay out its segment hashes as segmentedColorHashes does
+    referenceHashes = hashesOf(
+        referenceGallery, hashFunction, fingerprintCache=fingerprintCache
+    )[0]
+    targetHashes = hashesOf(
+        targetGallery, hashFunction, targetPipelinesOf(maxAngle), fingerprintCache
+    )
 
-    result = matrices[0]
-    for matrix in matrices[1:]:
-        for rowIndex, row in enumerate(matrix):
-            for columnIndex, column in enumerate(row):
-                targetColumn = result[rowIndex][columnIndex]
-                targetColumn["distance"] = targetColumn["distance"] + column["distance"]
-    for row in result:
-        for column in row:
-            column["distance"] = column["distance"] / len(matrices)
+    # segment bits of the references and of every target pipeline, for each colorhash variant
+    variants = [
+        (
+            [segmentBitsOf(multiHash, binbits) for multiHash in referenceHashes],
+            [
+                [segmentBitsOf(multiHash, binbits) for multiHash in pipelineHashes]
+                for pipelineHashes in targetHashes
+            ],
+        )
+        for binbits in [slice(0, 8), slice(8, 20)]
+    ]
 
-    return result
+    def distancesOf(referenceSlice, targetSlice):
+        # distance of each colorhash variant, on the best of the target pipelines, then averaged
+        distances = [
+            numpy.minimum(
+                MAX_HAMMING_DIST,
+                numpy.min(
+                    [
+                        multiHashDistancesBetween(
+                            referenceBits[referenceSlice],
+                            pipelineBits[targetSlice],
+                            POPCOUNT_TABLE,
+                        )
+                        for pipelineBits in targetBits
+                    ],
+                    axis=0,
+                ),
+            )
+            for referenceBits, targetBits in variants
+        ]
+        return (distances[0] + distances[1]) / len(distances)
 
+    # float64 distances of both variants for every target pipeline, the segments themselves
+    # being compared in blocks of at most SEGMENT_BLOCK_WORDS
+    return distancesOf, 2 * (len(targetHashes) + 1) * 8
 
-def cropResistantMatch(referenceGallery, targetGallery):
-    if len(referenceGallery) == 0 or len(targetGallery) == 0:
-        return []
 
-    hashingStrategies = [colorHashWith8Binbits, colorHashWith12Binbits]
-    hammingMatrices = [
-        hammingMatrixOf(
+def candidateMaskOf(referenceGallery, targetGallery, candidatePairs):
+    referenceIndexes = {
+        image["filename"]: index for index, image in enumerate(referenceGallery)
+    }
+    targetIndexes = {image["filename"]: index for index, image in enumerate(targetGallery)}
+    candidates = numpy.zeros((len(referenceGallery), len(targetGallery)), dtype=bool)
+    for reference, target in candidatePairs:
+        candidates[referenceIndexes[reference], targetIndexes[target]] = True
+
+    return candidates
+
+
+def maskedTilesOf(tiles, candidates):
+    distancesOf, bytesPerPair = tiles
+
+    def maskedDistancesOf(referenceSlice, targetSlice):
+        # the pairs ruled out by the prefilter keep the maximum distance
+        return numpy.where(
+            candidates[referenceSlice, targetSlice],
+            distancesOf(referenceSlice, targetSlice),
+            MAX_HAMMING_DIST,
+        )
+
+    return maskedDistancesOf, bytesPerPair + 8
+
+
+def candidateGalleriesOf(referenceGallery, targetGallery, candidatePairs):
+    references = {reference for reference, _ in candidatePairs}
+    targets = {target for _, target in candidatePairs}
+
+    return (
+        [image for image in referenceGallery if image["filename"] in references],
+        [image for image in targetGallery if image["filename"] in targets],
+    )
+
+
+def hashStageMatch(
+    stage,
+    referenceGallery,
+    targetGallery,
+    fingerprintCache=None,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    candidatePairs=None,
+    candidateSearch=False,
+    geometricSearch=False,
+    topCandidates=None,
+    memoryBudget=TILE_MEMORY_BUDGET,
+):
+    # the matches of a hash stage of the registry within its threshold, on the best rotation /
+    # flip of every target up to its maxAngle
+    hashStage = registeredStageOf(stage)
+    tilesOf = hashStage["tiles"] or vectorizedTilesOf
+    with profiledStage(stage):
+        if candidatePairs is not None:
+            # only the images taking part in a candidate pair get hashed
+            referenceGallery, targetGallery = candidateGalleriesOf(
+                referenceGallery, targetGallery, candidatePairs
+            )
+        if len(referenceGallery) == 0 or len(targetGallery) == 0:
+            return []
+
+        # the geometric search rotates the pHash inputs, and the candidate search indexes
+        # 64-bit hashes, which the vectorized tiles are made of
+        if geometricSearch and hashStage["hashFunction"] is imagehash.phash:
+            tiles = geometricTilesOf(
+                referenceGallery, targetGallery, hashStage["threshold"], hashStage["maxAngle"]
+            )
+        elif candidateSearch and candidatePairs is None and tilesOf is vectorizedTilesOf:
+            return candidateMatchesOf(
+                referenceGallery,
+                targetGallery,
+                hashStage["hashFunction"],
+                hashStage["threshold"],
+                hashStage["maxAngle"],
+                fingerprintCache,
+                assignmentBackend,
+            )
+        else:
+            tiles = tilesOf(
+                referenceGallery,
+                targetGallery,
+                hashStage["hashFunction"],
+                hashStage["maxAngle"],
+                fingerprintCache,
+            )
+        if candidatePairs is not None:
+            tiles = maskedTilesOf(
+                tiles, candidateMaskOf(referenceGallery, targetGallery, candidatePairs)
+            )
+
+        return tiledMatchesOf(
             referenceGallery,
             targetGallery,
-            hashingStrategy,
-            0,
+            tiles,
+            hashStage["threshold"],
+            assignmentBackend,
+            topCandidates,
+            memoryBudget,
         )
-        for hashingStrategy in hashingStrategies
-    ]
 
-    averagedHammingMatrix = averagedMatrices(hammingMatrices)
-    munkresMatrix = [[column["distance"] for column in row] for row in averagedHammingMatrix]
-    optimalMatches = [
-        averagedHammingMatrix[row][column] for row, column in Munkres().compute(munkresMatrix)
-    ]
 
-    return list(filter(lambda match: match["distance"] <= CROP_THRESHOLD, optimalMatches))
+def pixelDigestOf(image):
+    if "pixelDigest" not in image:
+        image["pixelDigest"] = hashlib.sha256(image["content"].tobytes()).hexdigest()
+
+    return image["pixelDigest"]
+
+
+def exactKeysOf(image):
+    # lazy galleries are only compared by file content, so that they don't get decoded,
+    # unless their pixel digests got computed while streaming them
+    keys = []
+    if "digest" in image:
+        keys.append(("file", image["digest"]))
+    if "content" in image or "pixelDigest" in image:
+        keys.append(("pixels", pixelDigestOf(image)))
+
+    return keys
+
+
+@profiled("exact")
+def exactMatch(referenceGallery, targetGallery):
+    referenceImages = collections.defaultdict(collections.deque)
+    for referenceImage in referenceGallery:
+        for key in exactKeysOf(referenceImage):
+            referenceImages[key].append(referenceImage)
+
+    matches = []
+    matchedReferences = set()
+    for targetImage in targetGallery:
+        for key in exactKeysOf(targetImage):
+            while len(referenceImages[key]) > 0 and (
+                referenceImages[key][0]["filename"] in matchedReferences
+            ):
+                referenceImages[key].popleft()
+            if len(referenceImages[key]) > 0:
+                referenceImage = referenceImages[key].popleft()
+                matchedReferences.add(referenceImage["filename"])
+                matches.append(
+                    {
+                        "distance": 0.0,
+                        "reference": referenceImage["filename"],
+                        "target": targetImage["filename"],
+                    }
+                )
+                break
+
+    return matches
+
+
+def globalColorHash(image):
+    return imagehash.colorhash(image, binbits=8)
+
+
+def prefilterPairsOf(stage, referenceGallery, targetGallery, fingerprintCache=None):
+    # returns the (reference, target) filename pairs whose hashes are within the threshold of a
+    # prefilter stage, e.g. close enough global colours to be worth segmenting for the
+    # crop-resistant hash
+    prefilter = registeredStageOf(stage)
+    with profiledStage(stage):
+        if len(referenceGallery) == 0 or len(targetGallery) == 0:
+            return set()
+
+        hashFunction = prefilter["hashFunction"]
+        referenceHashes, targetHashes = [
+            packedHashesOf(
+                hashesOf(gallery, hashFunction, fingerprintCache=fingerprintCache)[0]
+            )
+            for gallery in [referenceGallery, targetGallery]
+        ]
+        distances = popcountDistancesBetween(referenceHashes, targetHashes[numpy.newaxis])[:, 0]
+
+        return {
+            (
+                referenceGallery[referenceIndex]["filename"],
+                targetGallery[targetIndex]["filename"],
+            )
+            for referenceIndex, targetIndex in zip(
+                *numpy.nonzero(distances <= prefilter["threshold"])
+            )
+        }
+
+
+# the script may get imported again as matching.index, e.g. by a --stage-module, which mustn't
+# replace the stages of the running one
+registerStage("exact", "exact", cost=STAGE_COSTS["exact"], replace=False)
+for name, hashFunction, threshold, maxAngle in [
+    ("pHash", imagehash.phash, PHASH_THRESHOLD, MAX_ANGLE),
+    ("wHash", imagehash.whash, WHASH_THRESHOLD, 0),
+    ("dHash", imagehash.dhash, DHASH_THRESHOLD, 0),
+    ("aHash", imagehash.average_hash, AHASH_THRESHOLD, 0),
+]:
+    registerStage(
+        name,
+        "hash",
+        hashFunction,
+        threshold,
+        maxAngle,
+        STAGE_COSTS[name],
+        replace=False,
+    )
+registerStage(
+    "colorPrefilter",
+    "prefilter",
+    globalColorHash,
+    COLOR_PREFILTER_THRESHOLD,
+    cost=STAGE_COSTS["colorPrefilter"],
+    replace=False,
+)
+registerStage(
+    "cropResistantHash",
+    "hash",
+    segmentedColorHashes,
+    CROP_THRESHOLD,
+    cost=STAGE_COSTS["cropResistantHash"],
+    tiles=cropResistantTilesOf,
+    replace=False,
+)
+
+
+def stageHashesOf(stages, target=False):
+    # the hash function and transform pipelines each stage fingerprints images with
+    hashes = []
+    for stage in stages:
+        registeredStage = registeredStageOf(stage)
+        if registeredStage["hashFunction"] is None:
+            continue
+
+        transformPipelines = [IDENTITY_PIPELINE]
+        if target and registeredStage["kind"] == "hash":
+            transformPipelines = targetPipelinesOf(registeredStage["maxAngle"])
+        hashes.append((registeredStage["hashFunction"], transformPipelines))
+
+    return hashes
+
+
+def fingerprintGallery(
+    gallery, fingerprintCache, stages=CASCADE_STAGES, target=False, inFlight=None
+):
+    # decodes, transforms and fingerprints a lazy gallery for every stage, inFlight images at a
+    # time (all at once by default), dropping the decoded images as soon as they're hashed so
+    # that only their fingerprints stay in memory; the ones failing to decode get none, and
+    # keep their None content for the cascade to drop them
+    inFlight = inFlight or max(1, len(gallery))
+    with ThreadPoolExecutor(min(DECODE_WORKERS, inFlight)) as executor:
+        for first in range(0, len(gallery), inFlight):
+            images = gallery[first : first + inFlight]
+            list(executor.map(contentOf, images))
+            images = [image for image in images if not isUndecodable(image)]
+            if "exact" in stages:
+                for image in images:
+                    pixelDigestOf(image)
+
+            for hashFunction, transformPipelines in stageHashesOf(stages, target):
+                hashesOf(images, hashFunction, transformPipelines, fingerprintCache)
+
+            for image in images:
+                image.pop("content", None)
+
+
+def fingerprintReference(referenceGallery, fingerprintCache, stages=CASCADE_STAGES):
+    # hashes a reference once for every stage, so that diffing it against many targets only
+    # hashes the targets
+    fingerprintGallery(referenceGallery, fingerprintCache, stages)
 
 
 def galleriesWithoutMatches(referenceGallery, targetGallery, matches):
@@ -215,40 +982,538 @@ def generateChangelist(referenceGallery, targetGallery, matches, solvedBy, isFin
     return changelist
 
 
+def stageMatchesOf(
+    stage,
+    referenceGallery,
+    targetGallery,
+    candidatePairs=None,
+    fingerprintCache=None,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    candidateSearch=False,
+    geometricSearch=False,
+    topCandidates=None,
+    memoryBudget=TILE_MEMORY_BUDGET,
+):
+    # the matches of a stage, or the candidate pairs in the case of a prefilter
+    kind = registeredStageOf(stage)["kind"]
+    if kind == "prefilter":
+        return prefilterPairsOf(stage, referenceGallery, targetGallery, fingerprintCache)
+    if kind == "exact":
+        return exactMatch(referenceGallery, targetGallery)
+
+    return hashStageMatch(
+        stage,
+        referenceGallery,
+        targetGallery,
+        fingerprintCache,
+        assignmentBackend,
+        candidatePairs,
+        candidateSearch,
+        geometricSearch,
+        topCandidates,
+        memoryBudget,
+    )
+
+
+def decodableImagesOf(
+    gallery, stage, candidates=None, fingerprintCache=None, geometricSearch=False
+):
+    # a stage decodes the lazy images whose fingerprints it misses; decoding them here first
+    # lets the ones failing to (e.g. truncated files) get dropped, as eager galleries drop
+    # them; images with a fingerprint of the stage did decode, and only the candidates of a
+    # prefilter get hashed
+    hashFunction = registeredStageOf(stage)["hashFunction"]
+    if hashFunction is not None:
+        decodeAll = fingerprintCache is None or (
+            geometricSearch and hashFunction is imagehash.phash
+        )
+        parameters = {
+            reduced: hashParametersOf(hashFunction, IDENTITY_PIPELINE, reduced)
+            for reduced in [False, True]
+        }
+        decodedContentsOf(
+            [
+                image
+                for image in (gallery if candidates is None else candidates)
+                if "content" not in image
+                and (
+                    decodeAll
+                    or fingerprintCache.get(image["digest"], parameters[image["reduced"]])
+                    is None
+                )
+            ]
+        )
+
+    return [image for image in gallery if not isUndecodable(image)]
+
+
+def cascadeChanges(
+    referenceGallery,
+    targetGallery,
+    stages=CASCADE_STAGES,
+    fingerprintCache=None,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    candidateSearch=False,
+    geometricSearch=False,
+    topCandidates=None,
+    memoryBudget=TILE_MEMORY_BUDGET,
+    report=None,
+    matchStage=None,
+):
+    # each stage only sees the images left unmatched by the previous ones, and a prefilter
+    # restricts the pairs the next matching stage looks at; the changes of every stage get
+    # yielded as soon as it resolves them, and the stage reports appended to report;
+    # matchStage(stage, referenceGallery, targetGallery, candidatePairs) replaces
+    # stageMatchesOf, e.g. to run the stages somewhere else (which then decode the images);
+    # images failing to decode get dropped along the way
+    report = report if report is not None else []
+    decodeLazily = matchStage is None
+    if matchStage is None:
+        matchStage = functools.partial(
+            stageMatchesOf,
+            fingerprintCache=fingerprintCache,
+            assignmentBackend=assignmentBackend,
+            candidateSearch=candidateSearch,
+            geometricSearch=geometricSearch,
+            topCandidates=topCandidates,
+            memoryBudget=memoryBudget,
+        )
+
+    candidatePairs = None
+    for stage in stages:
+        start = time.perf_counter()
+        if decodeLazily:
+            candidates = [None, None]
+            if candidatePairs is not None:
+                candidates = candidateGalleriesOf(
+                    referenceGallery, targetGallery, candidatePairs
+                )
+            referenceGallery, targetGallery = [
+                decodableImagesOf(
+                    gallery, stage, stageCandidates, fingerprintCache, geometricSearch
+                )
+                for gallery, stageCandidates in zip(
+                    [referenceGallery, targetGallery], candidates
+                )
+            ]
+        else:
+            referenceGallery, targetGallery = [
+                [image for image in gallery if not isUndecodable(image)]
+                for gallery in [referenceGallery, targetGallery]
+            ]
+        stageReport = {
+            "stage": stage,
+            "references": len(referenceGallery),
+            "targets": len(targetGallery),
+            "pairs": len(referenceGallery) * len(targetGallery),
+        }
+        if registeredStageOf(stage)["kind"] == "prefilter":
+            candidatePairs = matchStage(stage, referenceGallery, targetGallery, None)
+            stageReport["candidatePairs"] = len(candidatePairs)
+            stageReport["seconds"] = time.perf_counter() - start
+            report.append(stageReport)
+            continue
+
+        if candidatePairs is not None:
+            stageReport["pairs"] = len(candidatePairs)
+        matches = matchStage(stage, referenceGallery, targetGallery, candidatePairs)
+
+        candidatePairs = None
+        stageReport["seconds"] = time.perf_counter() - start
+        stageReport["matches"] = len(matches)
+        report.append(stageReport)
+
+        referenceGallery, targetGallery = galleriesWithoutMatches(
+            referenceGallery, targetGallery, matches
+        )
+        yield from generateChangelist(referenceGallery, targetGallery, matches, stage, False)
+
+    yield from generateChangelist(referenceGallery, targetGallery, [], None)
+
+
+def cascadeChangelist(
+    referenceGallery,
+    targetGallery,
+    stages=CASCADE_STAGES,
+    fingerprintCache=None,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    candidateSearch=False,
+    geometricSearch=False,
+    topCandidates=None,
+    memoryBudget=TILE_MEMORY_BUDGET,
+    matchStage=None,
+):
+    report = []
+    changelist = list(
+        cascadeChanges(
+            referenceGallery,
+            targetGallery,
+            stages,
+            fingerprintCache,
+            assignmentBackend,
+            candidateSearch,
+            geometricSearch,
+            topCandidates,
+            memoryBudget,
+            report,
+            matchStage,
+        )
+    )
+
+    return changelist, report
+
+
+def cascadeParametersOf(
+    stages=CASCADE_STAGES,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    candidateSearch=False,
+    geometricSearch=False,
+    topCandidates=None,
+    reduced=False,
+):
+    # everything a changelist depends on besides the images themselves
+    return {
+        "stages": list(stages),
+        "assignmentBackend": assignmentBackend,
+        "candidateSearch": candidateSearch,
+        "geometricSearch": geometricSearch,
+        "topCandidates": topCandidates,
+        "reduced": reduced,
+        "thresholds": {
+            stage: [registeredStageOf(stage)["threshold"], registeredStageOf(stage)["maxAngle"]]
+            for stage in stages
+        },
+        "imagehash": imagehash.__version__,
+    }
+
+
+def incrementalChanges(
+    referenceGallery,
+    targetGallery,
+    manifest,
+    stages=CASCADE_STAGES,
+    fingerprintCache=None,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    candidateSearch=False,
+    geometricSearch=False,
+    topCandidates=None,
+    memoryBudget=TILE_MEMORY_BUDGET,
+    report=None,
+):
+    # repairs the changelist of a previous run: the matches between images that didn't change
+    # are kept as they are (and yielded first), and the cascade only runs on the new and changed
+    # images, along with the ones left unmatched or whose previous match is gone
+    report = report if report is not None else []
+    changedReferences = changedFilenamesOf(manifest["reference"], referenceGallery)
+    changedTargets = changedFilenamesOf(manifest["target"], targetGallery)
+    referenceFilenames = {image["filename"] for image in referenceGallery}
+    targetFilenames = {image["filename"] for image in targetGallery}
+
+    keptChanges = [
+        change
+        for change in manifest["changelist"]
+        if "reference" in change
+        and "target" in change
+        and change["reference"] in referenceFilenames - changedReferences
+        and change["target"] in targetFilenames - changedTargets
+    ]
+    matchedReferences = {change["reference"] for change in keptChanges}
+    matchedTargets = {change["target"] for change in keptChanges}
+
+    report.append(
+        {
+            "stage": "manifest",
+            "changedReferences": len(changedReferences),
+            "changedTargets": len(changedTargets),
+            "removedReferences": len(set(manifest["reference"]) - referenceFilenames),
+            "removedTargets": len(set(manifest["target"]) - targetFilenames),
+            "keptMatches": len(keptChanges),
+        }
+    )
+    yield from keptChanges
+    yield from cascadeChanges(
+        [image for image in referenceGallery if image["filename"] not in matchedReferences],
+        [image for image in targetGallery if image["filename"] not in matchedTargets],
+        stages,
+        fingerprintCache,
+        assignmentBackend,
+        candidateSearch,
+        geometricSearch,
+        topCandidates,
+        memoryBudget,
+        report,
+    )
+
+
+def incrementalChangelist(
+    referenceGallery,
+    targetGallery,
+    manifest,
+    stages=CASCADE_STAGES,
+    fingerprintCache=None,
+    assignmentBackend=ASSIGNMENT_BACKEND,
+    candidateSearch=False,
+    geometricSearch=False,
+    topCandidates=None,
+    memoryBudget=TILE_MEMORY_BUDGET,
+):
+    report = []
+    changelist = list(
+        incrementalChanges(
+            referenceGallery,
+            targetGallery,
+            manifest,
+            stages,
+            fingerprintCache,
+            assignmentBackend,
+            candidateSearch,
+            geometricSearch,
+            topCandidates,
+            memoryBudget,
+            report,
+        )
+    )
+
+    return changelist, report
+
+
 if __name__ == "__main__":
-    if (
-        not len(sys.argv) == 3
-        or not os.path.isdir(sys.argv[1])
-        or not os.path.isdir(sys.argv[2])
+    parser = argparse.ArgumentParser(
+        description="Computes the changelist between 2 photo galleries, "
+        "each of them a folder or a zip / tar archive"
+    )
+    parser.add_argument("referenceFolder")
+    parser.add_argument("targetFolder")
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"reuse fingerprints stored in {FINGERPRINT_CACHE_FILENAME} inside the reference folder "
+        f"(next to a reference archive, as <archive>{FINGERPRINT_CACHE_FILENAME})",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=FINGERPRINT_CACHE_MAX_BYTES // (1024 * 1024),
+        help="maximum size of the fingerprint cache, in megabytes",
+    )
+    parser.add_argument(
+        "--assignment",
+        choices=sorted(ASSIGNMENT_BACKENDS),
+        help="solver used to pair reference images with target images (default: "
+        f"{ASSIGNMENT_BACKEND}, or sparse with --candidates or --top-k)",
+    )
+    parser.add_argument(
+        "--candidates",
+        action="store_true",
+        help="only compare the pHashes within the threshold of each other (sparse assignment)",
+    )
+    parser.add_argument(
+        "--geometric-search",
+        action="store_true",
+        help="rotate and flip the 32x32 pHash inputs instead of the full images, "
+        "searching angles coarse-to-fine only for the pairs missing the threshold at 0 degrees",
+    )
+    parser.add_argument(
+        "--stages",
+        type=lambda stages: stages.split(","),
+        default=CASCADE_STAGES,
+        help=f"comma-separated matching stages, run in order (default: {','.join(CASCADE_STAGES)}), "
+        f"among {','.join(STAGE_REGISTRY)} and the ones registered by --stage-module",
+    )
+    parser.add_argument(
+        "--stage-module",
+        action="append",
+        default=[],
+        help="import this module first, e.g. for it to registerStage more stages (repeatable)",
+    )
+    parser.add_argument(
+        "--schedule",
+        help="order the stages by the seconds they took per image they matched in the runs "
+        "recorded in this file (prefilters staying right before their stage), skip the ones "
+        "that never matched, then record this run there",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="print the number of pairs each stage looked at and resolved to stderr",
+    )
+    parser.add_argument(
+        "--reduced-decode",
+        action="store_true",
+        help="decode JPEGs at a reduced scale that still covers the resize target",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        help="only keep the K closest targets within the threshold of every reference, "
+        "and solve the assignment on those pairs alone",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=TILE_MEMORY_BUDGET // (1024 * 1024),
+        help="maximum size of the distances computed at once, in megabytes",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="repair the changelist saved in this file by a previous run, only re-diffing the "
+        "images that changed since, then save the new one there (best along with --cache)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="decode, transform and fingerprint the galleries a few images at a time, only "
+        "keeping their fingerprints in memory (in the --cache if any, which has to fit them)",
+    )
+    parser.add_argument(
+        "--in-flight",
+        type=int,
+        default=STREAM_IN_FLIGHT,
+        help="maximum number of images decoded at once in streaming mode",
+    )
+    parser.add_argument(
+        "--format",
+        choices=CHANGE_FORMATS,
+        default="python",
+        help="python prints the changelist once done; jsonl writes every change as a JSON line "
+        "as soon as its stage resolves it, along with the stage and elapsed seconds; binary "
+        "writes the same records compactly (read them back with src/matching/sinks.py)",
+    )
+    parser.add_argument("--output", help="file to write the changelist to, instead of stdout")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print the time, peak memory and counters of every step to stderr, as JSON",
+    )
+    parser.add_argument(
+        "--cprofile",
+        help="dump cProfile statistics of the main process (not of the workers) to this file",
+    )
+    arguments = parser.parse_args()
+    # candidate pairs only hold the ones within the threshold, from which the dense solvers
+    # wouldn't find their optimum
+    if arguments.candidates or arguments.top_k is not None:
+        if arguments.assignment not in [None, *EDGE_BACKENDS]:
+            parser.error(
+                f"--candidates or --top-k only works with the {' or '.join(EDGE_BACKENDS)} assignment"
+            )
+        arguments.assignment = arguments.assignment or "sparse"
+    arguments.assignment = arguments.assignment or ASSIGNMENT_BACKEND
+
+    if not isGallerySource(arguments.referenceFolder) or not isGallerySource(
+        arguments.targetFolder
     ):
         print(
             'Usage: time python src/matching/index.py "/code/samples/002 - gin/original" "/code/samples/002 - gin/attack001"'
         )
         exit(-1)
+    if arguments.stream and arguments.geometric_search:
+        parser.error("--geometric-search needs the decoded images, it can't be streamed")
+    for module in arguments.stage_module:
+        importlib.import_module(module)
+    unknownStages = [stage for stage in arguments.stages if stage not in STAGE_REGISTRY]
+    if len(unknownStages) > 0:
+        parser.error(f"Unknown stages {','.join(unknownStages)}")
 
-    referenceFolder = os.path.normpath(sys.argv[1])
-    targetFolder = os.path.normpath(sys.argv[2])
+    report = []
+    stages = arguments.stages
+    if arguments.schedule is not None:
+        statistics = loadStatistics(arguments.schedule)
+        stages, skippedStages = scheduledStagesOf(stages, STAGE_REGISTRY, statistics)
+        report.append({"stage": "schedule", "stages": stages, "skipped": skippedStages})
 
-    referenceGallery = loadGallery(referenceFolder)
-    targetGallery = loadGallery(targetFolder)
+    referenceFolder = os.path.normpath(arguments.referenceFolder)
+    targetFolder = os.path.normpath(arguments.targetFolder)
 
-    pHashMatches = pHashMatch(referenceGallery, targetGallery)
-    referenceGallery, targetGallery = galleriesWithoutMatches(
-        referenceGallery, targetGallery, pHashMatches
-    )
-    changelist = generateChangelist(
-        referenceGallery, targetGallery, pHashMatches, "pHash", False
-    )
+    fingerprintCache = None
+    if arguments.cache:
+        fingerprintCache = FingerprintCache(
+            fingerprintCachePathOf(referenceFolder),
+            arguments.cache_size * 1024 * 1024,
+        )
+    elif arguments.stream:
+        fingerprintCache = MemoryFingerprintCache(arguments.cache_size * 1024 * 1024)
 
-    cropResistantHashes = cropResistantMatch(referenceGallery, targetGallery)
-    referenceGallery, targetGallery = galleriesWithoutMatches(
-        referenceGallery, targetGallery, cropResistantHashes
-    )
-    changelist = changelist + generateChangelist(
-        referenceGallery, targetGallery, cropResistantHashes, "cropResistantHash"
+    if arguments.profile:
+        startProfiling()
+    if arguments.cprofile is not None:
+        cProfiler = cProfile.Profile()
+        cProfiler.enable()
+
+    # file digests are what manifests tell changed images apart with
+    lazy = arguments.cache or arguments.stream or arguments.manifest is not None
+    referenceGallery = loadGallery(referenceFolder, lazy, arguments.reduced_decode)
+    targetGallery = loadGallery(targetFolder, lazy, arguments.reduced_decode)
+    if arguments.stream:
+        for gallery, target in [(referenceGallery, False), (targetGallery, True)]:
+            fingerprintGallery(gallery, fingerprintCache, stages, target, arguments.in_flight)
+
+    parameters = cascadeParametersOf(
+        stages,
+        arguments.assignment,
+        arguments.candidates,
+        arguments.geometric_search,
+        arguments.top_k,
+        arguments.reduced_decode,
     )
+    manifest = None
+    if arguments.manifest is not None:
+        manifest = loadManifest(arguments.manifest, parameters)
+
+    # changes get written as soon as their stage resolves them, the manifest only needing the
+    # whole changelist
+    sink = changeSinkOf(arguments.format, arguments.stages, arguments.output)
+    if manifest is not None:
+        changes = incrementalChanges(
+            referenceGallery,
+            targetGallery,
+            manifest,
+            stages,
+            fingerprintCache,
+            arguments.assignment,
+            arguments.candidates,
+            arguments.geometric_search,
+            arguments.top_k,
+            arguments.memory_budget * 1024 * 1024,
+            report,
+        )
+    else:
+        changes = cascadeChanges(
+            referenceGallery,
+            targetGallery,
+            stages,
+            fingerprintCache,
+            arguments.assignment,
+            arguments.candidates,
+            arguments.geometric_search,
+            arguments.top_k,
+            arguments.memory_budget * 1024 * 1024,
+            report,
+        )
+    changelist = []
+    for change in changes:
+        sink.write(change, report)
+        if arguments.manifest is not None:
+            changelist.append(change)
+
+    if fingerprintCache is not None:
+        fingerprintCache.close()
+    if arguments.schedule is not None:
+        saveStatistics(arguments.schedule, recordReport(statistics, report))
+    if arguments.manifest is not None:
+        saveManifest(
+            arguments.manifest, parameters, referenceGallery, targetGallery, changelist
+        )
+
+    if arguments.cprofile is not None:
+        cProfiler.disable()
+        cProfiler.dump_stats(arguments.cprofile)
 
-    print(changelist)
+    sink.close()
+    if arguments.report:
+        print(json.dumps(report, indent=4), file=sys.stderr)
+    if arguments.profile:
+        print(json.dumps(stopProfiling(), indent=4), file=sys.stderr)
 
     # TODO: should also test how it handles watermarks
     # TODO: will not work when crop is combined with others
@@ -0,0 +1,43 @@
+import json, os
+
+from matching.files import saveJson
+
+MANIFEST_VERSION = 1  # manifests saved with another version get ignored
+
+
+def digestsOf(gallery):
+    return {image["filename"]: image["digest"] for image in gallery}
+
+
+def changedFilenamesOf(previousDigests, gallery):
+    # the images that are new, or whose content changed, since the manifest got saved
+    return {
+        image["filename"]
+        for image in gallery
+        if previousDigests.get(image["filename"]) != image["digest"]
+    }
+
+
+def loadManifest(path, parameters):
+    # the manifest of the previous run, as long as it was computed with the same parameters
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as file:
+        manifest = json.load(file)
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("parameters") != parameters:
+        return None
+
+    return manifest
+
+
+def saveManifest(path, parameters, referenceGallery, targetGallery, changelist):
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "parameters": parameters,
+        "reference": digestsOf(referenceGallery),
+        "target": digestsOf(targetGallery),
+        "changelist": changelist,
+    }
+
+    saveJson(path, manifest)
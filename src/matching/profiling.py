@@ -0,0 +1,170 @@
+import collections, contextlib, functools, os, resource, threading, time
+
+profiler = None  # only set while profiling, every hook being a no-op otherwise
+NO_STAGE = contextlib.nullcontext()
+SAMPLING_SECONDS = 0.05
+
+
+def parentsOf():
+    parents = {}
+    for pid in os.listdir("/proc"):
+        if pid.isdigit():
+            try:
+                with open(f"/proc/{pid}/stat") as stat:
+                    # the command name is parenthesized and may hold spaces
+                    parents[int(pid)] = int(stat.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+
+    return parents
+
+
+def processTreeOf(root):
+    children = collections.defaultdict(list)
+    for pid, parent in parentsOf().items():
+        children[parent].append(pid)
+
+    tree, pending = [], [root]
+    while len(pending) > 0:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children[pid])
+
+    return tree
+
+
+def pssKilobytesOf(pid):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as smaps:
+            for line in smaps:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return 0
+
+
+def treeMemoryMegabytes():
+    # the proportional set size of this process and of its workers, so that pages shared
+    # between them (the forked interpreter, shared image blocks) are only counted once
+    if not os.path.isdir("/proc"):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return sum(pssKilobytesOf(pid) for pid in processTreeOf(os.getpid())) / 1024
+
+
+class Profiler:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()  # decoding and services record from several threads
+        # the peak memory of every running stage, updated by the sampling thread
+        self.runningPeaks = {}
+        self.peakMemory = treeMemoryMegabytes()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while not self.stopped.wait(SAMPLING_SECONDS):
+            self.record(treeMemoryMegabytes())
+
+    def record(self, memory):
+        with self.lock:
+            self.peakMemory = max(self.peakMemory, memory)
+            for peak in self.runningPeaks.values():
+                peak[0] = max(peak[0], memory)
+
+    def close(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        startMemory = treeMemoryMegabytes()
+        peak, key = [startMemory], object()  # stages of the same name can nest or overlap
+        with self.lock:
+            self.runningPeaks[key] = peak
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.record(treeMemoryMegabytes())
+            with self.lock:
+                del self.runningPeaks[key]
+                stage = self.stages.setdefault(
+                    name,
+                    {
+                        "calls": 0,
+                        "seconds": 0.0,
+                        "peakTreeMemoryMegabytes": 0.0,
+                        "treeMemoryGrowthMegabytes": 0.0,
+                    },
+                )
+                stage["calls"] += 1
+                stage["seconds"] += seconds
+                stage["peakTreeMemoryMegabytes"] = max(
+                    stage["peakTreeMemoryMegabytes"], peak[0]
+                )
+                stage["treeMemoryGrowthMegabytes"] += peak[0] - startMemory
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] += amount
+
+    def summary(self):
+        # stages nest (e.g. assignment inside pHash) and the ones running on several threads
+        # (decode, resize) add up the time of each thread; memory is sampled every
+        # SAMPLING_SECONDS, so shorter spikes may be missed
+        with self.lock:
+            return {
+                "seconds": time.perf_counter() - self.start,
+                "peakTreeMemoryMegabytes": self.peakMemory,
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+
+def startProfiling():
+    global profiler
+    profiler = Profiler()
+
+
+def stopProfiling():
+    global profiler
+    profiler.close()
+    summary = profiler.summary()
+    profiler = None
+
+    return summary
+
+
+def profiledStage(name):
+    if profiler is None:
+        return NO_STAGE
+
+    return profiler.stage(name)
+
+
+def profiledCount(name, amount=1):
+    if profiler is not None:
+        profiler.count(name, amount)
+
+
+def profiled(name):
+    # times every call of the decorated function as the given stage
+    def decorator(function):
+        @functools.wraps(function)
+        def profiledFunction(*arguments, **keywordArguments):
+            if profiler is None:
+                return function(*arguments, **keywordArguments)
+
+            with profiler.stage(name):
+                return function(*arguments, **keywordArguments)
+
+        return profiledFunction
+
+    return decorator
@@ -0,0 +1,102 @@
+import json, os
+
+from matching.files import saveJson
+
+SCHEDULE_PRIOR_PAIRS = 100  # pairs the declared cost weighs as, against measured ones
+SCHEDULE_PRIOR_IMAGES = 10  # images the prior yield weighs as, against measured ones
+SCHEDULE_PRIOR_YIELD = 0.5  # fraction of the images left a stage is assumed to match at first
+SCHEDULE_MIN_YIELD = 1e-3  # so that stages that never match sort last instead of dividing by 0
+SCHEDULE_MIN_IMAGES = 50  # images a stage gets skipped after looking at without a match
+SCHEDULE_EXPLORATION_RUNS = 10  # skipped stages run again every that many runs, in case
+
+
+def loadStatistics(path):
+    if not os.path.isfile(path):
+        return {"runs": 0, "stages": {}}
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def saveStatistics(path, statistics):
+    saveJson(path, statistics, indent=4)
+
+
+def recordReport(statistics, report):
+    # adds up the seconds, pairs and matches of every stage of a cascade's report
+    statistics["runs"] += 1
+    for stageReport in report:
+        if "seconds" not in stageReport:
+            continue
+
+        stage = statistics["stages"].setdefault(
+            stageReport["stage"],
+            {"runs": 0, "seconds": 0.0, "pairs": 0, "images": 0, "matches": 0},
+        )
+        stage["runs"] += 1
+        stage["seconds"] += stageReport["seconds"]
+        stage["pairs"] += stageReport["references"] * stageReport["targets"]
+        stage["images"] += min(stageReport["references"], stageReport["targets"])
+        stage["matches"] += stageReport.get("matches", 0)
+
+    return statistics
+
+
+def stageUnitsOf(stages, registry):
+    # a prefilter only restricts the stage right after it, so both get scheduled together
+    units = [[]]
+    for stage in stages:
+        units[-1].append(stage)
+        if registry[stage]["kind"] != "prefilter":
+            units.append([])
+
+    return [unit for unit in units if len(unit) > 0]
+
+
+def secondsPerPairOf(stage, registry, statistics):
+    recorded = statistics["stages"].get(stage, {"seconds": 0.0, "pairs": 0})
+    return (recorded["seconds"] + registry[stage]["cost"] * SCHEDULE_PRIOR_PAIRS) / (
+        recorded["pairs"] + SCHEDULE_PRIOR_PAIRS
+    )
+
+
+def yieldOf(stage, registry, statistics):
+    # the fraction of the images left that the stage matches
+    if registry[stage]["kind"] == "prefilter":
+        return 0.0
+
+    recorded = statistics["stages"].get(stage, {"images": 0, "matches": 0})
+    return (recorded["matches"] + SCHEDULE_PRIOR_YIELD * SCHEDULE_PRIOR_IMAGES) / (
+        recorded["images"] + SCHEDULE_PRIOR_IMAGES
+    )
+
+
+def isBarren(stage, statistics):
+    # only the images a stage got to look at count, not the runs in which the previous stages
+    # left it nothing
+    recorded = statistics["stages"].get(stage, {"images": 0, "matches": 0})
+    return recorded["images"] >= SCHEDULE_MIN_IMAGES and recorded["matches"] == 0
+
+
+def scheduledStagesOf(stages, registry, statistics):
+    # orders the stages by their seconds per pair over the fraction of the images they match,
+    # so that cheap stages that match a lot go first and leave fewer images to the expensive
+    # ones, and skips the ones that never matched anything (but on exploration runs); returns
+    # the stages to run, in order, and the skipped ones
+    units = stageUnitsOf(stages, registry)
+    skippedUnits = []
+    if (statistics["runs"] + 1) % SCHEDULE_EXPLORATION_RUNS != 0:
+        skippedUnits = [unit for unit in units if isBarren(unit[-1], statistics)]
+        if len(skippedUnits) == len(units):
+            skippedUnits = []
+
+    scheduledUnits = sorted(
+        [unit for unit in units if unit not in skippedUnits],
+        key=lambda unit: sum(secondsPerPairOf(stage, registry, statistics) for stage in unit)
+        / max(SCHEDULE_MIN_YIELD, yieldOf(unit[-1], registry, statistics)),
+    )
+
+    return (
+        [stage for unit in scheduledUnits for stage in unit],
+        [stage for unit in skippedUnits for stage in unit],
+    )
@@ -0,0 +1,108 @@
+import imagehash, numpy
+
+from PIL import Image, ImageFilter
+
+SEGMENT_THRESHOLD = 128  # imagehash.crop_resistant_hash's defaults
+MIN_SEGMENT_SIZE = 500
+SEGMENTATION_IMAGE_SIZE = 300
+BIT_ERROR_RATE = 0.25  # ImageMultiHash's default share of bits a matching segment may differ by
+SEGMENT_BLOCK_WORDS = 1 << 22  # reference x target segment words XOR-ed at once
+
+
+def cropResistantHashesOf(image, hashFunctions):
+    # imagehash.crop_resistant_hash for several hash functions, sharing a single segmentation
+    pixels = numpy.array(
+        image.convert("L")
+        .resize((SEGMENTATION_IMAGE_SIZE, SEGMENTATION_IMAGE_SIZE), Image.LANCZOS)
+        .filter(ImageFilter.GaussianBlur())
+        .filter(ImageFilter.MedianFilter())
+    ).astype(numpy.float32)
+
+    segments = imagehash._find_all_segments(pixels, SEGMENT_THRESHOLD, MIN_SEGMENT_SIZE)
+    if not segments:
+        segments.append({(0, 0), (SEGMENTATION_IMAGE_SIZE - 1, SEGMENTATION_IMAGE_SIZE - 1)})
+
+    width, height = image.size
+    scaleWidth = float(width) / SEGMENTATION_IMAGE_SIZE
+    scaleHeight = float(height) / SEGMENTATION_IMAGE_SIZE
+    boundingBoxes = [
+        image.crop(
+            (
+                min(coordinate[1] for coordinate in segment) * scaleWidth,
+                min(coordinate[0] for coordinate in segment) * scaleHeight,
+                (max(coordinate[1] for coordinate in segment) + 1) * scaleWidth,
+                (max(coordinate[0] for coordinate in segment) + 1) * scaleHeight,
+            )
+        )
+        for segment in segments
+    ]
+
+    return [
+        imagehash.ImageMultiHash([hashFunction(boundingBox) for boundingBox in boundingBoxes])
+        for hashFunction in hashFunctions
+    ]
+
+
+def packedSegmentsOf(segmentBits):
+    # segmentBits holds one S x B boolean array per image; returns all the segments packed
+    # into 64-bit words, along with the index of each image's first segment
+    bits = numpy.concatenate(segmentBits)
+    padding = numpy.zeros((len(bits), -bits.shape[1] % 64), dtype=bool)
+    packed = numpy.packbits(numpy.concatenate([bits, padding], axis=1), axis=1)
+    counts = numpy.array([len(segments) for segments in segmentBits])
+
+    return packed.view(numpy.uint64), numpy.cumsum(counts) - counts, counts
+
+
+def multiHashDistancesBetween(referenceSegmentBits, targetSegmentBits, popcountTable):
+    # R x T matrix of ImageMultiHash differences (reference - target), segment by segment
+    bitCount = referenceSegmentBits[0].shape[1]
+    hammingCutoff = bitCount * BIT_ERROR_RATE
+    referenceSegments, referenceStarts, referenceCounts = packedSegmentsOf(referenceSegmentBits)
+    targetSegments, targetStarts, _ = packedSegmentsOf(targetSegmentBits)
+
+    blockSize = max(1, SEGMENT_BLOCK_WORDS // targetSegments.size)
+    distances = numpy.empty((len(referenceSegmentBits), len(targetSegmentBits)))
+    firstReference = 0
+    while firstReference < len(referenceSegmentBits):
+        # as many whole references as fit in a block, but at least one
+        lastReference = firstReference + 1
+        while (
+            lastReference < len(referenceSegmentBits)
+            and referenceStarts[lastReference]
+            + referenceCounts[lastReference]
+            - referenceStarts[firstReference]
+            <= blockSize
+        ):
+            lastReference += 1
+
+        blockStart = referenceStarts[firstReference]
+        blockEnd = referenceStarts[lastReference - 1] + referenceCounts[lastReference - 1]
+        differentBits = (
+            referenceSegments[blockStart:blockEnd, numpy.newaxis, :]
+            ^ targetSegments[numpy.newaxis, :, :]
+        )
+        segmentDistances = popcountTable[differentBits.view(numpy.uint8)].sum(
+            axis=-1, dtype=numpy.int64
+        )
+
+        # closest target segment of every reference segment, then per reference image
+        lowestDistances = numpy.minimum.reduceat(segmentDistances, targetStarts, axis=1)
+        withinCutoff = lowestDistances <= hammingCutoff
+        blockStarts = referenceStarts[firstReference:lastReference] - blockStart
+        matches = numpy.add.reduceat(withinCutoff, blockStarts, axis=0).astype(numpy.float64)
+        sums = numpy.add.reduceat(
+            numpy.where(withinCutoff, lowestDistances, 0), blockStarts, axis=0
+        ).astype(numpy.float64)
+
+        maxDifferences = referenceCounts[firstReference:lastReference, numpy.newaxis].astype(
+            numpy.float64
+        )
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            matchScores = matches + (0 - sums / (matches * bitCount))
+        distances[firstReference:lastReference] = numpy.where(
+            matches == 0, maxDifferences, maxDifferences - matchScores
+        )
+        firstReference = lastReference
+
+    return distances
@@ -0,0 +1,452 @@
+import argparse, functools, importlib, ipaddress, json, numpy, os, secrets, socket, subprocess
+import sys
+
+from multiprocessing.connection import Client, Listener
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from matching.assignment import ASSIGNMENT_BACKENDS, EDGE_BACKENDS
+from matching.cache import FINGERPRINT_CACHE_MAX_BYTES, MemoryFingerprintCache
+from matching.index import (
+    ASSIGNMENT_BACKEND,
+    CASCADE_STAGES,
+    STREAM_IN_FLIGHT,
+    candidateGalleriesOf,
+    candidateMaskOf,
+    cascadeChanges,
+    edgeMatchesOf,
+    exactMatch,
+    fingerprintGallery,
+    isGallerySource,
+    isUndecodable,
+    loadGallery,
+    maskedTilesOf,
+    optimalMatchesOf,
+    prefilterPairsOf,
+    vectorizedTilesOf,
+)
+from matching.sinks import CHANGE_FORMATS, changeSinkOf
+from matching.stages import STAGE_REGISTRY, registeredStageOf
+from matching.tiles import TILE_MEMORY_BUDGET, tiledDistancesOf, topCandidatesOf
+
+SHARD_ADDRESS = "localhost:0"  # port 0 picks a free one
+SHARD_AUTHKEY_VARIABLE = "GALLERY_DIFFER_AUTHKEY"  # shared secret of coordinator and workers
+DENSE_BACKENDS = {"dense", "munkres"}  # solved on whole rows, not just the close pairs
+
+
+def addressOf(hostAndPort):
+    host, port = hostAndPort.rsplit(":", 1)
+    return host, int(port)
+
+
+def authkeyOf():
+    # messages get unpickled, so whoever knows the key can run code on the other end
+    return os.environ.get(SHARD_AUTHKEY_VARIABLE, "").encode() or None
+
+
+def isLoopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def shardsOf(gallery, count):
+    # contiguous slices, so that the rows of every shard stay in the gallery's order
+    return [
+        gallery[len(gallery) * shard // count : len(gallery) * (shard + 1) // count]
+        for shard in range(count)
+    ]
+
+
+def shardResultOf(
+    stage,
+    referenceGallery,
+    targetGallery,
+    candidatePairs,
+    assignmentBackend,
+    topCandidates,
+    memoryBudget,
+    fingerprintCache,
+):
+    # what a worker computes for its references: the candidate pairs of a prefilter, or the
+    # distances of a hash stage, as whole rows for the dense solvers and as the pairs within
+    # the threshold otherwise
+    registeredStage = registeredStageOf(stage)
+    if registeredStage["kind"] == "prefilter":
+        return prefilterPairsOf(stage, referenceGallery, targetGallery, fingerprintCache)
+
+    tilesOf = registeredStage["tiles"] or vectorizedTilesOf
+    distancesOf, bytesPerPair = tilesOf(
+        referenceGallery,
+        targetGallery,
+        registeredStage["hashFunction"],
+        registeredStage["maxAngle"],
+        fingerprintCache,
+    )
+    if candidatePairs is not None:
+        distancesOf, bytesPerPair = maskedTilesOf(
+            (distancesOf, bytesPerPair),
+            candidateMaskOf(referenceGallery, targetGallery, candidatePairs),
+        )
+
+    shape = (len(referenceGallery), len(targetGallery))
+    if topCandidates is None and assignmentBackend in DENSE_BACKENDS:
+        return tiledDistancesOf(*shape, distancesOf, bytesPerPair, memoryBudget)
+
+    return topCandidatesOf(
+        *shape,
+        distancesOf,
+        registeredStage["threshold"],
+        topCandidates or len(targetGallery),
+        bytesPerPair,
+        memoryBudget,
+    )
+
+
+def runWorker(address, cacheSize=FINGERPRINT_CACHE_MAX_BYTES):
+    # serves the coordinator until it closes the connection: fingerprints a slice of each
+    # gallery, takes in the fingerprints of every target, then computes each stage's shard
+    fingerprintCache = MemoryFingerprintCache(cacheSize)
+    with Client(address, authkey=authkeyOf()) as connection:
+        while True:
+            message = connection.recv()
+            if message[0] == "fingerprint":
+                _, referenceGallery, targetGallery, stages, stageModules = message
+                for module in stageModules:
+                    importlib.import_module(module)
+                fingerprintGallery(
+                    referenceGallery, fingerprintCache, stages, inFlight=STREAM_IN_FLIGHT
+                )
+                fingerprintGallery(
+                    targetGallery, fingerprintCache, stages, True, STREAM_IN_FLIGHT
+                )
+                connection.send(
+                    (
+                        [image.get("pixelDigest") for image in referenceGallery],
+                        [image.get("pixelDigest") for image in targetGallery],
+                        [isUndecodable(image) for image in referenceGallery + targetGallery],
+                        fingerprintCache.entriesOf(
+                            {image["digest"] for image in targetGallery}
+                        ),
+                    )
+                )
+            elif message[0] == "fingerprints":
+                for entry in message[1]:
+                    fingerprintCache.put(*entry)
+            elif message[0] == "stage":
+                connection.send(shardResultOf(*message[1:], fingerprintCache))
+            else:
+                return
+
+
+def exchange(connections, messages):
+    # every worker gets its message before any reply is awaited, so that they run at once
+    for connection, message in zip(connections, messages):
+        connection.send(message)
+
+    return [connection.recv() for connection in connections]
+
+
+def fingerprintShards(connections, referenceGallery, targetGallery, stages, stageModules=[]):
+    # each worker fingerprints a slice of both galleries, then gets the fingerprints of every
+    # target; the references of a slice are the ones its worker diffs in every stage, after
+    # importing the modules registering the stages
+    referenceShards = shardsOf(referenceGallery, len(connections))
+    targetShards = shardsOf(targetGallery, len(connections))
+    for shard, images in enumerate(referenceShards):
+        for image in images:
+            image["shard"] = shard
+
+    targetEntries = []
+    results = exchange(
+        connections,
+        [
+            ("fingerprint", referenceImages, targetImages, stages, stageModules)
+            for referenceImages, targetImages in zip(referenceShards, targetShards)
+        ],
+    )
+    for referenceImages, targetImages, result in zip(referenceShards, targetShards, results):
+        referenceDigests, targetDigests, undecodable, entries = result
+        for image, pixelDigest, isImageUndecodable in zip(
+            referenceImages + targetImages, referenceDigests + targetDigests, undecodable
+        ):
+            if pixelDigest is not None:
+                image["pixelDigest"] = pixelDigest
+            # for the cascade to drop it, as the worker couldn't decode it
+            if isImageUndecodable:
+                image["content"] = None
+        targetEntries += entries
+
+    for connection in connections:
+        connection.send(("fingerprints", targetEntries))
+
+
+def shardedStageMatchesOf(
+    connections,
+    assignmentBackend,
+    topCandidates,
+    memoryBudget,
+    stage,
+    referenceGallery,
+    targetGallery,
+    candidatePairs,
+):
+    # stageMatchesOf, with the distances computed by the workers and merged back here, in the
+    # order the single-process run would have them in
+    kind = registeredStageOf(stage)["kind"]
+    if kind == "exact":
+        return exactMatch(referenceGallery, targetGallery)
+
+    if kind == "hash" and candidatePairs is not None:
+        referenceGallery, targetGallery = candidateGalleriesOf(
+            referenceGallery, targetGallery, candidatePairs
+        )
+    if len(referenceGallery) == 0 or len(targetGallery) == 0:
+        return set() if kind == "prefilter" else []
+
+    shards = [
+        (connection, [image for image in referenceGallery if image["shard"] == shard])
+        for shard, connection in enumerate(connections)
+    ]
+    shards = [(connection, images) for connection, images in shards if len(images) > 0]
+    messages = []
+    for _, images in shards:
+        shardPairs = None
+        if candidatePairs is not None:
+            filenames = {image["filename"] for image in images}
+            shardPairs = {pair for pair in candidatePairs if pair[0] in filenames}
+        messages.append(
+            (
+                "stage",
+                stage,
+                images,
+                targetGallery,
+                shardPairs,
+                assignmentBackend,
+                topCandidates,
+                memoryBudget,
+            )
+        )
+    results = exchange([connection for connection, _ in shards], messages)
+
+    if kind == "prefilter":
+        return set().union(*results)
+    if isinstance(results[0], numpy.ndarray):
+        return optimalMatchesOf(
+            numpy.concatenate(results),
+            referenceGallery,
+            targetGallery,
+            registeredStageOf(stage)["threshold"],
+            assignmentBackend,
+        )
+
+    offsets = numpy.cumsum([0] + [len(images) for _, images in shards])
+    rows, columns, distances = [
+        numpy.concatenate(arrays)
+        for arrays in zip(
+            *[
+                (rows + offset, columns, distances)
+                for (rows, columns, distances), offset in zip(results, offsets)
+            ]
+        )
+    ]
+    if topCandidates is None:
+        # the pairs within the threshold, as the whole matrix would list them
+        order = numpy.lexsort((columns, rows))
+        rows, columns, distances = rows[order], columns[order], distances[order]
+
+    return edgeMatchesOf(
+        referenceGallery, targetGallery, rows, columns, distances, assignmentBackend
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Computes the changelist between 2 photo galleries, split between several "
+        "worker processes which may run on other machines"
+    )
+    parser.add_argument("referenceFolder", nargs="?")
+    parser.add_argument("targetFolder", nargs="?")
+    parser.add_argument(
+        "--worker",
+        metavar="HOST:PORT",
+        help="run as a worker of the coordinator listening on this address instead",
+    )
+    parser.add_argument("--shards", type=int, default=2, help="number of workers")
+    parser.add_argument(
+        "--local-workers",
+        type=int,
+        help="workers started on this machine, the others having to connect by themselves "
+        "(default: all of them)",
+    )
+    parser.add_argument(
+        "--listen",
+        default=SHARD_ADDRESS,
+        metavar="HOST:PORT",
+        help=f"address the coordinator waits for workers on (default: {SHARD_ADDRESS})",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=FINGERPRINT_CACHE_MAX_BYTES // (1024 * 1024),
+        help="maximum size of the fingerprints each worker keeps, in megabytes",
+    )
+    parser.add_argument(
+        "--assignment",
+        choices=sorted(ASSIGNMENT_BACKENDS),
+        help="solver used to pair reference images with target images (default: "
+        f"{ASSIGNMENT_BACKEND}, or sparse with --top-k)",
+    )
+    parser.add_argument(
+        "--stages",
+        type=lambda stages: stages.split(","),
+        default=CASCADE_STAGES,
+        help=f"comma-separated matching stages, run in order (default: {','.join(CASCADE_STAGES)})",
+    )
+    parser.add_argument(
+        "--stage-module",
+        action="append",
+        default=[],
+        help="import this module first, e.g. for it to registerStage more stages (repeatable); "
+        "workers import it too, so it has to be importable on their machines",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        help="only keep the K closest targets within the threshold of every reference",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=TILE_MEMORY_BUDGET // (1024 * 1024),
+        help="maximum size of the distances each worker computes at once, in megabytes",
+    )
+    parser.add_argument(
+        "--format",
+        choices=CHANGE_FORMATS,
+        default="python",
+        help="how to write the changelist, as in src/matching/index.py",
+    )
+    parser.add_argument("--output", help="file to write the changelist to, instead of stdout")
+    parser.add_argument(
+        "--reduced-decode",
+        action="store_true",
+        help="decode JPEGs at a reduced scale that still covers the resize target",
+    )
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="print the number of pairs each stage looked at and resolved to stderr",
+    )
+    arguments = parser.parse_args()
+    # candidate pairs only hold the ones within the threshold, from which the dense solvers
+    # wouldn't find their optimum
+    if arguments.top_k is not None:
+        if arguments.assignment not in [None, *EDGE_BACKENDS]:
+            parser.error(f"--top-k only works with the {' or '.join(EDGE_BACKENDS)} assignment")
+        arguments.assignment = arguments.assignment or "sparse"
+    arguments.assignment = arguments.assignment or ASSIGNMENT_BACKEND
+
+    if arguments.worker is not None:
+        if authkeyOf() is None:
+            parser.error(f"Workers need the coordinator's secret in {SHARD_AUTHKEY_VARIABLE}")
+        runWorker(addressOf(arguments.worker), arguments.cache_size * 1024 * 1024)
+        exit(0)
+
+    if (
+        arguments.referenceFolder is None
+        or arguments.targetFolder is None
+        or not isGallerySource(arguments.referenceFolder)
+        or not isGallerySource(arguments.targetFolder)
+    ):
+        print(
+            'Usage: time python src/matching/shards.py "/code/samples/002 - gin/original" "/code/samples/002 - gin/attack001" --shards 4'
+        )
+        exit(-1)
+    for module in arguments.stage_module:
+        importlib.import_module(module)
+    unknownStages = [stage for stage in arguments.stages if stage not in STAGE_REGISTRY]
+    if len(unknownStages) > 0:
+        parser.error(f"Unknown stages {','.join(unknownStages)}")
+
+    # a random secret is only good for the workers started here, which get it from their
+    # environment, so listening beyond this machine needs one set by hand
+    authkey = authkeyOf()
+    workerEnvironment = dict(os.environ)
+    if authkey is None:
+        if not isLoopback(addressOf(arguments.listen)[0]):
+            parser.error(
+                f"Set a secret in {SHARD_AUTHKEY_VARIABLE} to listen on {arguments.listen}"
+            )
+        authkey = secrets.token_hex(32).encode()
+        workerEnvironment[SHARD_AUTHKEY_VARIABLE] = authkey.decode()
+
+    with Listener(addressOf(arguments.listen), authkey=authkey) as listener:
+        host, port = listener.address
+        localWorkers = arguments.shards
+        if arguments.local_workers is not None:
+            localWorkers = min(arguments.local_workers, arguments.shards)
+        workers = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--worker",
+                    f"{host}:{port}",
+                    "--cache-size",
+                    str(arguments.cache_size),
+                ],
+                env=workerEnvironment,
+            )
+            for _ in range(localWorkers)
+        ]
+        if localWorkers < arguments.shards:
+            print(
+                f"Waiting for {arguments.shards - localWorkers} workers on {host}:{port}",
+                file=sys.stderr,
+            )
+        connections = [listener.accept() for _ in range(arguments.shards)]
+
+    # workers read the images (or archives) from the same paths, e.g. on a shared file system
+    referenceGallery = loadGallery(
+        os.path.abspath(arguments.referenceFolder), True, arguments.reduced_decode
+    )
+    targetGallery = loadGallery(
+        os.path.abspath(arguments.targetFolder), True, arguments.reduced_decode
+    )
+    fingerprintShards(
+        connections,
+        referenceGallery,
+        targetGallery,
+        arguments.stages,
+        arguments.stage_module,
+    )
+
+    report = []
+    sink = changeSinkOf(arguments.format, arguments.stages, arguments.output)
+    for change in cascadeChanges(
+        referenceGallery,
+        targetGallery,
+        arguments.stages,
+        assignmentBackend=arguments.assignment,
+        topCandidates=arguments.top_k,
+        report=report,
+        matchStage=functools.partial(
+            shardedStageMatchesOf,
+            connections,
+            arguments.assignment,
+            arguments.top_k,
+            arguments.memory_budget * 1024 * 1024,
+        ),
+    ):
+        sink.write(change, report)
+
+    for connection in connections:
+        connection.send(("close",))
+        connection.close()
+    for worker in workers:
+        worker.wait()
+
+    sink.close()
+    if arguments.report:
+        print(json.dumps(report, indent=4), file=sys.stderr)
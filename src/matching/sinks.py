@@ -0,0 +1,170 @@
+import abc, argparse, json, math, struct, sys, time
+
+CHANGE_FORMATS = ["python", "jsonl", "binary"]
+CHANGE_RESOLUTIONS = ["unchanged", "light changes", "removed", "added"]
+BINARY_MAGIC = b"GDCHANGES1\n"
+BINARY_RECORD = struct.Struct(
+    "<BBdff"
+)  # resolution, stage, distance, stage and elapsed seconds
+BINARY_LENGTH = struct.Struct("<H")
+NO_NAME = 0xFFFF  # length of a missing reference or target
+NO_STAGE = 0xFF
+
+
+def stageSecondsOf(change, report):
+    # cascades append the report of a stage right before yielding its changes, so the changes
+    # left for the end (and the ones kept from a manifest) have no stage time
+    if len(report) == 0 or report[-1]["stage"] != change.get("solvedBy"):
+        return None
+
+    return report[-1].get("seconds")
+
+
+class ChangeSink(abc.ABC):
+    def __init__(self, file):
+        self.file = file
+        self.start = time.perf_counter()
+
+    def write(self, change, report):
+        self.record(change, stageSecondsOf(change, report), time.perf_counter() - self.start)
+
+    @abc.abstractmethod
+    def record(self, change, stageSeconds, elapsedSeconds):
+        # writes (or keeps) a change, stageSeconds being None when its stage's time is unknown
+        pass
+
+    def close(self):
+        self.file.flush()
+        if self.file not in [sys.stdout, sys.stdout.buffer]:
+            self.file.close()
+
+
+class PythonSink(ChangeSink):
+    # the whole changelist as a Python list, once the cascade is over
+    def __init__(self, file):
+        super().__init__(file)
+        self.changelist = []
+
+    def record(self, change, stageSeconds, elapsedSeconds):
+        self.changelist.append(change)
+
+    def close(self):
+        print(self.changelist, file=self.file)
+        super().close()
+
+
+class JsonLinesSink(ChangeSink):
+    # one JSON object per change, written as soon as its stage resolves it
+    def record(self, change, stageSeconds, elapsedSeconds):
+        record = {**change, "stageSeconds": stageSeconds, "elapsedSeconds": elapsedSeconds}
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+
+class BinarySink(ChangeSink):
+    # a header naming the stages, then a fixed-size record per change followed by its
+    # length-prefixed UTF-8 reference and target filenames
+    def __init__(self, file, stages):
+        super().__init__(file)
+        self.stages = list(stages)
+        self.file.write(BINARY_MAGIC + encodedNamesOf(self.stages))
+
+    def record(self, change, stageSeconds, elapsedSeconds):
+        stage = change.get("solvedBy")
+        self.file.write(
+            BINARY_RECORD.pack(
+                CHANGE_RESOLUTIONS.index(change["resolution"]),
+                self.stages.index(stage) if stage is not None else NO_STAGE,
+                change.get("distance", math.nan),
+                stageSeconds if stageSeconds is not None else math.nan,
+                elapsedSeconds,
+            )
+            + encodedNameOf(change.get("reference"))
+            + encodedNameOf(change.get("target"))
+        )
+        self.file.flush()
+
+
+def encodedNameOf(name):
+    if name is None:
+        return BINARY_LENGTH.pack(NO_NAME)
+
+    encoded = name.encode("utf-8")
+    return BINARY_LENGTH.pack(len(encoded)) + encoded
+
+
+def encodedNamesOf(names):
+    return bytes([len(names)]) + b"".join(encodedNameOf(name) for name in names)
+
+
+def readExactly(file, size):
+    data = file.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated binary changelist")
+
+    return data
+
+
+def decodedNameOf(file):
+    (length,) = BINARY_LENGTH.unpack(readExactly(file, BINARY_LENGTH.size))
+    if length == NO_NAME:
+        return None
+
+    return readExactly(file, length).decode("utf-8")
+
+
+def binaryChangesOf(file):
+    # yields the records of a binary changelist, as the JSON lines sink would have written them
+    if file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+        raise ValueError("Not a binary changelist")
+
+    stages = [decodedNameOf(file) for _ in range(readExactly(file, 1)[0])]
+    while True:
+        data = file.read(BINARY_RECORD.size)
+        if len(data) == 0:
+            return
+        if len(data) != BINARY_RECORD.size:
+            raise ValueError("Truncated binary changelist")
+
+        resolution, stage, distance, stageSeconds, elapsedSeconds = BINARY_RECORD.unpack(data)
+        reference = decodedNameOf(file)
+        target = decodedNameOf(file)
+
+        change = {}
+        if not math.isnan(distance):
+            change["distance"] = distance
+        if reference is not None:
+            change["reference"] = reference
+        if target is not None:
+            change["target"] = target
+        change["resolution"] = CHANGE_RESOLUTIONS[resolution]
+        if stage != NO_STAGE:
+            change["solvedBy"] = stages[stage]
+        change["stageSeconds"] = None if math.isnan(stageSeconds) else stageSeconds
+        change["elapsedSeconds"] = elapsedSeconds
+
+        yield change
+
+
+def changeSinkOf(changeFormat, stages, path=None):
+    # writes to stdout unless given a file
+    if changeFormat == "binary":
+        return BinarySink(open(path, "wb") if path else sys.stdout.buffer, stages)
+
+    file = open(path, "w") if path else sys.stdout
+    if changeFormat == "jsonl":
+        return JsonLinesSink(file)
+
+    return PythonSink(file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prints a binary changelist as JSON lines, e.g. to inspect it"
+    )
+    parser.add_argument("changelist")
+    arguments = parser.parse_args()
+
+    with open(arguments.changelist, "rb") as file:
+        for change in binaryChangesOf(file):
+            print(json.dumps(change))
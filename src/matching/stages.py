@@ -0,0 +1,67 @@
+STAGE_KINDS = ["exact", "prefilter", "hash"]
+
+# every stage the cascade can run: "exact" matches identical files or pixels, "prefilter"
+# stages restrict the pairs the next stage looks at to the ones within their threshold, and
+# "hash" stages match the images within their threshold, rotating and flipping the targets up
+# to maxAngle; cost is a prior of the seconds per pair, until the scheduler measures it
+STAGE_REGISTRY = {}
+
+
+def registerStage(
+    name,
+    kind="hash",
+    hashFunction=None,
+    threshold=None,
+    maxAngle=0,
+    cost=1e-3,
+    tiles=None,
+    replace=True,
+    cacheKey=None,
+):
+    # hash functions run on the worker pool, so they have to be picklable (module functions,
+    # or partials of them); tiles(referenceGallery, targetGallery, hashFunction, maxAngle,
+    # fingerprintCache) returns the distance tiles of a hash stage, the vectorized ones of any
+    # fixed-size ImageHash by default; cacheKey names the hashes in fingerprint caches, to be
+    # changed along with the hash function
+    if kind not in STAGE_KINDS:
+        raise ValueError(f"Stage kinds have to be among {','.join(STAGE_KINDS)}")
+    if not replace and name in STAGE_REGISTRY:
+        return
+
+    STAGE_REGISTRY[name] = {
+        "kind": kind,
+        "hashFunction": hashFunction,
+        "threshold": threshold,
+        "maxAngle": maxAngle,
+        "cost": cost,
+        "tiles": tiles,
+        "cacheKey": cacheKey,
+    }
+
+
+def registeredStageOf(stage):
+    if stage not in STAGE_REGISTRY:
+        raise ValueError(f"Unknown stage {stage}")
+
+    return STAGE_REGISTRY[stage]
+
+
+def cacheKeyOf(hashFunction):
+    # the cacheKey of the stage registered with the hash function, else its module and name,
+    # else the stage's name (e.g. for partials, which have neither)
+    stages = [
+        (name, stage)
+        for name, stage in STAGE_REGISTRY.items()
+        if stage["hashFunction"] is hashFunction
+    ]
+    for _, stage in stages:
+        if stage["cacheKey"] is not None:
+            return stage["cacheKey"]
+
+    qualifiedName = getattr(hashFunction, "__qualname__", None)
+    if qualifiedName is not None:
+        return f"{getattr(hashFunction, '__module__', None)}.{qualifiedName}"
+    if len(stages) > 0:
+        return stages[0][0]
+
+    raise ValueError(f"Register {hashFunction!r} with a cacheKey to cache its hashes")
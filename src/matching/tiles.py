@@ -0,0 +1,92 @@
+import numpy
+
+TILE_MEMORY_BUDGET = 128 * 1024 * 1024  # bytes the intermediate arrays of a tile may take
+
+
+def tileShapeOf(referenceCount, targetCount, bytesPerPair, memoryBudget=TILE_MEMORY_BUDGET):
+    # whole rows of targets as long as they fit, then as many references as the budget allows
+    tileColumns = int(max(1, min(targetCount, memoryBudget // bytesPerPair)))
+    tileRows = int(max(1, min(referenceCount, memoryBudget // (bytesPerPair * tileColumns))))
+
+    return tileRows, tileColumns
+
+
+def rowBlocksOf(referenceCount, targetCount, bytesPerPair, memoryBudget=TILE_MEMORY_BUDGET):
+    # yields every block of references along with the target slices it gets compared with
+    tileRows, tileColumns = tileShapeOf(referenceCount, targetCount, bytesPerPair, memoryBudget)
+    targetSlices = [
+        slice(firstColumn, min(firstColumn + tileColumns, targetCount))
+        for firstColumn in range(0, targetCount, tileColumns)
+    ]
+    for firstRow in range(0, referenceCount, tileRows):
+        yield slice(firstRow, min(firstRow + tileRows, referenceCount)), targetSlices
+
+
+def tiledDistancesOf(
+    referenceCount, targetCount, distancesOf, bytesPerPair, memoryBudget=TILE_MEMORY_BUDGET
+):
+    # the whole R x T matrix, in the compact dtype distancesOf returns its tiles in
+    distances = None
+    for referenceSlice, targetSlices in rowBlocksOf(
+        referenceCount, targetCount, bytesPerPair, memoryBudget
+    ):
+        for targetSlice in targetSlices:
+            tileDistances = distancesOf(referenceSlice, targetSlice)
+            if distances is None:
+                distances = numpy.empty(
+                    (referenceCount, targetCount), dtype=tileDistances.dtype
+                )
+            distances[referenceSlice, targetSlice] = tileDistances
+
+    if distances is None:
+        return numpy.empty((referenceCount, targetCount))
+
+    return distances
+
+
+def closestCandidatesOf(rows, columns, distances, topCandidates):
+    # the topCandidates closest columns of every row, ties going to the lowest column
+    order = numpy.lexsort((columns, distances, rows))
+    rows, columns, distances = rows[order], columns[order], distances[order]
+    ranks = numpy.arange(len(rows)) - numpy.searchsorted(rows, rows)
+    kept = ranks < topCandidates
+
+    return rows[kept], columns[kept], distances[kept]
+
+
+def topCandidatesOf(
+    referenceCount,
+    targetCount,
+    distancesOf,
+    threshold,
+    topCandidates,
+    bytesPerPair,
+    memoryBudget=TILE_MEMORY_BUDGET,
+):
+    # keeps the topCandidates closest targets within the threshold of every reference, as
+    # (reference index, target index, distance) arrays, without ever holding the whole matrix
+    candidates = []
+    for referenceSlice, targetSlices in rowBlocksOf(
+        referenceCount, targetCount, bytesPerPair, memoryBudget
+    ):
+        blockCandidates = None
+        for targetSlice in targetSlices:
+            tileDistances = distancesOf(referenceSlice, targetSlice)
+            tileRows, tileColumns = numpy.nonzero(tileDistances <= threshold)
+            tileCandidates = [
+                (tileRows + referenceSlice.start).astype(numpy.int32),
+                (tileColumns + targetSlice.start).astype(numpy.int32),
+                tileDistances[tileRows, tileColumns],
+            ]
+            if blockCandidates is not None:
+                tileCandidates = [
+                    numpy.concatenate(arrays) for arrays in zip(blockCandidates, tileCandidates)
+                ]
+            blockCandidates = closestCandidatesOf(*tileCandidates, topCandidates)
+
+        candidates.append(blockCandidates)
+
+    if len(candidates) == 0:
+        return numpy.empty(0, numpy.int32), numpy.empty(0, numpy.int32), numpy.empty(0)
+
+    return tuple(numpy.concatenate(arrays) for arrays in zip(*candidates))
@@ -0,0 +1,89 @@
+import atexit, functools, threading
+import numpy
+
+from PIL import Image
+from multiprocessing import Pool, cpu_count, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+engine = None
+engineLock = threading.Lock()  # a service may ask for the engine from several threads
+
+
+class SharedImages:
+    # copies equally-sized images into one shared memory block, so that workers only
+    # need its name and an index instead of a pickled copy of every image
+    def __init__(self, images):
+        self.shape = (len(images), *(images[0].shape if len(images) > 0 else ()))
+        self.block = SharedMemory(create=True, size=max(1, int(numpy.prod(self.shape))))
+        if len(images) > 0:
+            sharedImages = numpy.ndarray(self.shape, dtype=numpy.uint8, buffer=self.block.buf)
+            for index, image in enumerate(images):
+                sharedImages[index] = image
+
+    @property
+    def name(self):
+        return self.block.name
+
+    def close(self):
+        self.block.close()
+        self.block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def sharedImageOf(name, shape, index):
+    # workers only keep the block mapped for as long as it takes to copy the image out, since
+    # the parent unlinking it does not free its memory while any process still maps it
+    block = SharedMemory(name=name)
+    image = numpy.ndarray(shape, dtype=numpy.uint8, buffer=block.buf)[index].copy()
+    block.close()
+
+    return image
+
+
+def sharedImageHashOf(name, shape, transformPipelines, hashFunction, task):
+    pipelineIndex, imageIndex = task
+    image = sharedImageOf(name, shape, imageIndex)
+
+    return hashFunction(
+        Image.fromarray(transformPipelines[pipelineIndex](image=image)["image"])
+    )
+
+
+class WorkerEngine:
+    def __init__(self, processes=None):
+        # the forked workers have to share the parent's tracker, otherwise each of them would
+        # report the blocks it attached to as leaked when exiting
+        resource_tracker.ensure_running()
+        self.pool = Pool(processes or cpu_count())
+
+    def hashes(self, sharedImages, transformPipelines, hashFunction, tasks):
+        return self.pool.map(
+            functools.partial(
+                sharedImageHashOf,
+                sharedImages.name,
+                sharedImages.shape,
+                transformPipelines,
+                hashFunction,
+            ),
+            tasks,
+        )
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def workerEngine():
+    # created on first use, then reused by every stage and request of the process
+    global engine
+    with engineLock:
+        if engine is None:
+            engine = WorkerEngine()
+            atexit.register(engine.close)
+
+    return engine
@@ -1,8 +1,310 @@
-from flask import Flask
+import collections, json, os, sys, tarfile, tempfile, threading, time, uuid, zipfile
+import numpy
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, abort, jsonify, request
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from matching.archives import archiveNamesOf, closeArchive, isArchive
+from matching.cache import FINGERPRINT_CACHE_MAX_BYTES, MemoryFingerprintCache
+from matching.index import (
+    CASCADE_STAGES,
+    cascadeChanges,
+    fingerprintReference,
+    isGallerySource,
+    loadGallery,
+)
+from matching.stages import STAGE_REGISTRY
+from matching.workers import workerEngine
+
+JOB_WORKERS = 2  # diffs running at once, each of them already spreading over the worker pool
+MAX_QUEUED_JOBS = 32  # waiting diffs above which new ones get rejected
+MAX_KEPT_JOBS = 1000  # finished diffs kept around for their changelist and stats
+FINISHED_STATUSES = ["done", "failed"]
 
 server = Flask(__name__)
+fingerprintCache = MemoryFingerprintCache(FINGERPRINT_CACHE_MAX_BYTES)
+executor = ThreadPoolExecutor(JOB_WORKERS)
+references = {}
+jobs = collections.OrderedDict()
+stateLock = threading.Lock()
+latencies = collections.deque(maxlen=MAX_KEPT_JOBS)  # (submitted, started, finished) times
+
+
+def errorOf(message, status):
+    return Response(json.dumps({"error": message}), status, mimetype="application/json")
+
+
+def removeArchive(path):
+    closeArchive(path)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def gallerySourceOf(request):
+    # either a folder the server can read, or an uploaded zip / tar archive, which gets read in
+    # place from a temporary file; returns the gallery source and the temporary file, if any
+    if "archive" in request.files:
+        descriptor, temporaryArchive = tempfile.mkstemp()
+        os.close(descriptor)
+        request.files["archive"].save(temporaryArchive)
+        try:
+            if not isArchive(temporaryArchive):
+                raise tarfile.TarError()
+            archiveNamesOf(temporaryArchive)  # rejects bad member lists upfront
+        except (zipfile.BadZipFile, tarfile.TarError):
+            removeArchive(temporaryArchive)
+            abort(errorOf("Archives have to be zip or tar files", 400))
+        except ValueError as error:
+            removeArchive(temporaryArchive)
+            abort(errorOf(str(error), 400))
+
+        return temporaryArchive, temporaryArchive
+
+    folder = (request.get_json(silent=True) or request.form).get("folder")
+    if folder is None or not isGallerySource(folder):
+        abort(errorOf("No such folder or archive", 400))
+
+    return os.path.normpath(folder), None
+
+
+def summaryOf(durations):
+    if len(durations) == 0:
+        return None
+
+    return {
+        "mean": float(numpy.mean(durations)),
+        "p50": float(numpy.percentile(durations, 50)),
+        "p95": float(numpy.percentile(durations, 95)),
+        "max": float(numpy.max(durations)),
+    }
+
+
+def jobOf(jobId):
+    with stateLock:
+        if jobId not in jobs:
+            abort(404)
+
+        return jobs[jobId]
+
+
+def runJob(job, referenceGallery, targetSource, temporaryArchive):
+    with job["condition"]:
+        job["status"] = "running"
+        job["started"] = time.time()
+
+    try:
+        # jobs only get copies of the reference images, decoded again if their fingerprints
+        # ever got evicted from the cache
+        referenceGallery = [dict(image) for image in referenceGallery]
+        targetGallery = loadGallery(targetSource, lazy=True)
+        for change in cascadeChanges(
+            referenceGallery,
+            targetGallery,
+            job["stages"],
+            fingerprintCache,
+            report=job["report"],
+        ):
+            with job["condition"]:
+                job["changes"].append(change)
+                job["condition"].notify_all()
+        status = "done"
+    except Exception as error:
+        job["error"] = str(error)
+        status = "failed"
+    finally:
+        if temporaryArchive is not None:
+            removeArchive(temporaryArchive)
+
+    with job["condition"]:
+        job["status"] = status
+        job["finished"] = time.time()
+        job["condition"].notify_all()
+
+    with stateLock:
+        latencies.append((job["submitted"], job["started"], job["finished"]))
+        finishedJobs = [
+            jobId for jobId, keptJob in jobs.items() if keptJob["status"] in FINISHED_STATUSES
+        ]
+        for jobId in finishedJobs[: max(0, len(finishedJobs) - MAX_KEPT_JOBS)]:
+            del jobs[jobId]
 
 
 @server.route("/")
 def hello():
     return "Hello World!"
+
+
+@server.route("/references", methods=["POST"])
+def registerReference():
+    # the reference fingerprints get computed once here, every diff against it reusing them
+    source, temporaryArchive = gallerySourceOf(request)
+    gallery = loadGallery(source, lazy=True)
+    fingerprintReference(gallery, fingerprintCache)
+
+    reference = {
+        "id": uuid.uuid4().hex,
+        "source": source,
+        "temporaryArchive": temporaryArchive,
+        "gallery": gallery,
+        "registered": time.time(),
+    }
+    with stateLock:
+        references[reference["id"]] = reference
+
+    return jsonify({"reference": reference["id"], "images": len(gallery)}), 201
+
+
+@server.route("/references", methods=["GET"])
+def listReferences():
+    with stateLock:
+        return jsonify(
+            [
+                {"reference": reference["id"], "images": len(reference["gallery"])}
+                for reference in references.values()
+            ]
+        )
+
+
+@server.route("/references/<referenceId>", methods=["DELETE"])
+def deleteReference(referenceId):
+    with stateLock:
+        if referenceId not in references:
+            abort(404)
+        reference = references.pop(referenceId)
+
+    if reference["temporaryArchive"] is not None:
+        removeArchive(reference["temporaryArchive"])
+
+    return "", 204
+
+
+@server.route("/references/<referenceId>/diffs", methods=["POST"])
+def submitDiff(referenceId):
+    with stateLock:
+        if referenceId not in references:
+            abort(404)
+        referenceGallery = references[referenceId]["gallery"]
+        queuedJobs = sum(job["status"] == "queued" for job in jobs.values())
+    if queuedJobs >= MAX_QUEUED_JOBS:
+        return errorOf("Too many queued diffs", 503)
+
+    body = request.get_json(silent=True)
+    stages = (body if isinstance(body, dict) else request.form).get("stages")
+    if stages is None:
+        stages = CASCADE_STAGES
+    elif isinstance(stages, str):
+        stages = stages.split(",")
+    elif not isinstance(stages, list) or any(not isinstance(stage, str) for stage in stages):
+        return errorOf("Stages have to be a list or a comma-separated string", 400)
+    if any(stage not in STAGE_REGISTRY for stage in stages):
+        return errorOf(f"Stages have to be among {','.join(STAGE_REGISTRY)}", 400)
+
+    targetSource, temporaryArchive = gallerySourceOf(request)
+    job = {
+        "id": uuid.uuid4().hex,
+        "reference": referenceId,
+        "stages": stages,
+        "status": "queued",
+        "submitted": time.time(),
+        "started": None,
+        "finished": None,
+        "changes": [],
+        "report": [],
+        "error": None,
+        "condition": threading.Condition(),
+    }
+    with stateLock:
+        jobs[job["id"]] = job
+    executor.submit(runJob, job, referenceGallery, targetSource, temporaryArchive)
+
+    return jsonify({"job": job["id"]}), 202
+
+
+@server.route("/jobs/<jobId>")
+def jobStatus(jobId):
+    job = jobOf(jobId)
+    with job["condition"]:
+        return jsonify(
+            {
+                "job": job["id"],
+                "reference": job["reference"],
+                "status": job["status"],
+                "changes": len(job["changes"]),
+                "report": job["report"],
+                "error": job["error"],
+                "submitted": job["submitted"],
+                "started": job["started"],
+                "finished": job["finished"],
+            }
+        )
+
+
+@server.route("/jobs/<jobId>/changelist")
+def jobChangelist(jobId):
+    # streams the changelist as JSON lines, each stage's changes as soon as it resolves them
+    job = jobOf(jobId)
+
+    def changes():
+        sent = 0
+        while True:
+            with job["condition"]:
+                job["condition"].wait_for(
+                    lambda: len(job["changes"]) > sent or job["status"] in FINISHED_STATUSES
+                )
+                pending = job["changes"][sent:]
+                status = job["status"]
+
+            for change in pending:
+                yield json.dumps(change) + "\n"
+            sent += len(pending)
+
+            if status in FINISHED_STATUSES and sent == len(job["changes"]):
+                if status == "failed":
+                    yield json.dumps({"error": job["error"]}) + "\n"
+                return
+
+    return Response(changes(), mimetype="application/x-ndjson")
+
+
+@server.route("/stats")
+def stats():
+    with stateLock:
+        statuses = collections.Counter(job["status"] for job in jobs.values())
+        recentLatencies = list(latencies)
+        referenceCount = len(references)
+
+    jobsPerSecond = None
+    if len(recentLatencies) > 1:
+        elapsed = max(finished for _, _, finished in recentLatencies) - min(
+            submitted for submitted, _, _ in recentLatencies
+        )
+        jobsPerSecond = len(recentLatencies) / elapsed if elapsed > 0 else None
+
+    return jsonify(
+        {
+            "queueDepth": statuses["queued"],
+            "running": statuses["running"],
+            "done": statuses["done"],
+            "failed": statuses["failed"],
+            "references": referenceCount,
+            "cachedFingerprints": len(fingerprintCache.fingerprints),
+            "cachedBytes": fingerprintCache.size,
+            "latency": {
+                "queued": summaryOf(
+                    [started - submitted for submitted, started, _ in recentLatencies]
+                ),
+                "running": summaryOf(
+                    [finished - started for _, started, finished in recentLatencies]
+                ),
+                "total": summaryOf(
+                    [finished - submitted for submitted, _, finished in recentLatencies]
+                ),
+            },
+            "jobsPerSecond": jobsPerSecond,
+        }
+    )
+
+
+# the worker processes get forked before any request thread exists
+workerEngine()